@@ -0,0 +1,106 @@
+import argparse
+import json
+import subprocess
+import sys
+
+import pygame
+
+import main
+
+
+NPC_COUNTS = [3, 50, 200, 500]
+FIRE_INTERVALS = [0, 10, 2]  # ticks between left clicks, 0 means no shooting
+MOVE_KEYS = [pygame.K_d, pygame.K_s, pygame.K_a, pygame.K_w]
+
+
+def make_script(fire_every, power_balls):
+    def script(tick, game):
+        events = []
+        mouse_pos = (0, 0) if (tick // 30) % 2 else (main.SCREEN_WIDTH, 0)
+        if fire_every and tick % fire_every == 0:
+            events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=mouse_pos))
+        if power_balls and game.power_bar.get_power_level() >= 100:
+            events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=3, pos=mouse_pos))
+        # Walk in a square so the player keeps changing animation and the wave keeps moving
+        keys = main.PressedKeys([MOVE_KEYS[(tick // 45) % len(MOVE_KEYS)]])
+        return main.InputFrame(events, keys, mouse_pos)
+
+    return script
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(ticks, seed, npc_backend, npc_counts, dirty_rects=False, track_allocations=False):
+    results = []
+    for num_npcs in npc_counts:
+        for fire_every in FIRE_INTERVALS:
+            for power_balls in (False, True):
+                profiler = main.FrameProfiler(memory=True) if track_allocations else None
+                try:
+                    tick_times = main.run_headless(ticks, seed, num_npcs, npc_backend,
+                                                   make_script(fire_every, power_balls), dirty_rects, profiler)
+                finally:
+                    if profiler is not None:
+                        profiler.close()
+                result = {"npcs": num_npcs, "fire_every": fire_every, "power_balls": power_balls}
+                result.update(main.summarize_tick_times(tick_times))
+                line = (f"npcs={num_npcs} fire_every={fire_every} power_balls={power_balls} "
+                        f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms")
+                if profiler is not None:
+                    result["memory"] = profiler.memory.report()
+                    line += f" alloc={result['memory']['steady_state_bytes_per_tick']:.0f}B/tick"
+                results.append(result)
+                print(line, file=sys.stderr)
+    return results
+
+
+def over_allocation_budget(results, max_bytes_per_tick):
+    return [result for result in results
+            if result["memory"]["steady_state_bytes_per_tick"] > max_bytes_per_tick]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless frame-time benchmark for Violet')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--numpy-npcs', action='store_true')
+    parser.add_argument('--dirty-rects', action='store_true')
+    parser.add_argument('--npcs', type=int, nargs='+', default=NPC_COUNTS)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--track-allocations', action='store_true',
+                        help='also report allocations and GC pauses, tick times are much slower with it')
+    parser.add_argument('--max-alloc-per-tick', type=int,
+                        help='fail when any scenario allocates more bytes per tick than this once warmed up '
+                             '(implies --track-allocations)')
+    args = parser.parse_args()
+    track_allocations = args.track_allocations or args.max_alloc_per_tick is not None
+
+    npc_backend = 'numpy' if args.numpy_npcs else None
+    report = {
+        "revision": git_revision(),
+        "ticks": args.ticks,
+        "seed": args.seed,
+        "npc_backend": npc_backend or 'entity',
+        "dirty_rects": args.dirty_rects,
+        "track_allocations": track_allocations,
+        "scenarios": run_suite(args.ticks, args.seed, npc_backend, args.npcs, args.dirty_rects, track_allocations),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.max_alloc_per_tick is not None:
+        failed = over_allocation_budget(report["scenarios"], args.max_alloc_per_tick)
+        for result in failed:
+            print(f"FAIL npcs={result['npcs']} fire_every={result['fire_every']} power_balls={result['power_balls']}: "
+                  f"{result['memory']['steady_state_bytes_per_tick']:.0f} bytes/tick > {args.max_alloc_per_tick}",
+                  file=sys.stderr)
+        if failed:
+            sys.exit(1)
@@ -1,11 +1,32 @@
+import argparse
+import csv
+import gc
+import json
+import mmap
+import os
 import sys
+import threading
 import time
+import tracemalloc
 import random
 import math
+import heapq
+import struct
+from array import array
 import copy
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import pygame
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class AnimatedSprite:
     def __init__(self):
@@ -16,18 +37,34 @@ class AnimatedSprite:
         self.x_position = 0
         self.y_position = 0
         self.flip_vertically = False
+        self.frame_variant = None
+        self.phase = 0
 
     def add_animation(self, name, sprite_sheet_path, num_frames, frame_duration, scale=1.0):
-        sprite_sheet = pygame.image.load(sprite_sheet_path).convert_alpha()
-        frames = self._extract_frames(sprite_sheet, num_frames, scale)
+        # Frames are shared with every other sprite using the same sheet, never modify them in place
+        cache_key, entry = sprite_sheet_cache.acquire(sprite_sheet_path, num_frames, scale)
+        self._release_animation(name)
 
         self.animations[name] = {
-            "frames": frames,
+            "frames": entry["frames"],
+            "variants": entry["variants"],
             "frame_duration": frame_duration,
-            "num_frames": num_frames
+            "num_frames": num_frames,
+            "cache_key": cache_key
         }
 
-    def _extract_frames(self, sprite_sheet, num_frames, scale):
+    def _release_animation(self, name):
+        animation = self.animations.get(name)
+        if animation and animation['cache_key'] is not None:
+            sprite_sheet_cache.release(animation['cache_key'])
+            animation['cache_key'] = None
+
+    def release(self):
+        for name in self.animations:
+            self._release_animation(name)
+
+    @staticmethod
+    def _extract_frames(sprite_sheet, num_frames, scale):
         frame_width = sprite_sheet.get_width() // num_frames
         frame_height = sprite_sheet.get_height()
 
@@ -56,33 +93,192 @@ class AnimatedSprite:
             self.frame_time = 0
             self.current_frame = (self.current_frame + 1) % self.animations[self.current_animation]['num_frames']
 
-    def draw(self, screen):
-        if not self.current_animation:
-            return
-
-        displayed_frame = pygame.transform.flip(self.animations[self.current_animation]['frames'][self.current_frame],
-                                                self.flip_vertically, False)
-        screen.blit(displayed_frame, (self.x_position, self.y_position))
-
-    def draw_sprite(self, screen, elapsed_time):
-        self.update(elapsed_time)
-        self.draw(screen)
+    def current_surface(self):
+        variant = 'flip_x' if self.flip_vertically else self.frame_variant
+        return self.get_frames(self.current_animation, variant)[self.current_frame]
+
+    def clip_surface(self, clock_ms):
+        # Plays the current animation as a clip on a shared clock, offset by phase, without touching the sprite state
+        animation = self.animations[self.current_animation]
+        frame = int((clock_ms + self.phase) // animation['frame_duration']) % animation['num_frames']
+        variant = 'flip_x' if self.flip_vertically else self.frame_variant
+        return self.get_frames(self.current_animation, variant)[frame]
+
+    def get_frames(self, animation_name, variant=None):
+        animation = self.animations[animation_name]
+        if variant is None:
+            return animation['frames']
+        # Variants are built once on first use and shared by every sprite using the same frames
+        frames = animation['variants'].get(variant)
+        if frames is None:
+            transform = FRAME_VARIANTS[variant]
+            frames = [transform(frame) for frame in animation['frames']]
+            animation['variants'][variant] = frames
+        return frames
 
     def resize(self, animation_name, scale):
         if animation_name not in self.animations:
             print(f"No animation named {animation_name} found!")
             return
 
+        # The resized frames are private to this sprite, so the shared ones can be given back
+        self._release_animation(animation_name)
         self.animations[animation_name]['frames'] = [
             pygame.transform.scale(frame, (int(frame.get_width() * scale), int(frame.get_height() * scale)))
             for frame in self.animations[animation_name]['frames']
         ]
+        self.animations[animation_name]['variants'] = {}
 
     def get_frame_width(self):
-        return self.animations[self.current_animation]['frames'][self.current_frame].get_width()
+        # In world units, frames are smaller than that when the scene is rendered at a lower resolution
+        frame = self.animations[self.current_animation]['frames'][self.current_frame]
+        return frame.get_width() * sprite_sheet_cache.render_scale
 
     def get_frame_height(self):
-        return self.animations[self.current_animation]['frames'][self.current_frame].get_height()
+        frame = self.animations[self.current_animation]['frames'][self.current_frame]
+        return frame.get_height() * sprite_sheet_cache.render_scale
+
+FRAME_VARIANTS = {
+    'flip_x': lambda frame: pygame.transform.flip(frame, True, False),
+    'flip_y': lambda frame: pygame.transform.flip(frame, False, True),
+}
+
+
+def register_frame_variant(name, transform):
+    FRAME_VARIANTS[name] = transform
+
+
+ASSET_BUNDLE_INDEX = 'assets/sprites.atlas.json'
+ASSET_BUNDLE_PIXELS = 'assets/sprites.atlas.rgba'
+# Byte order of a 32 bit ARGB display surface, frames in any other order take SDL's slow path on every blit
+ASSET_BUNDLE_FORMAT = 'BGRA'
+
+
+class SpriteSheetCache:
+    def __init__(self, max_unused=8):
+        self.entries = {}
+        self.ref_counts = {}
+        self.unused = OrderedDict()
+        self.max_unused = max_unused
+        self.bundled = {}
+        self.bundle_buffer = None
+        # Frames are loaded this many times smaller than asked for when the scene is drawn at low resolution
+        self.render_scale = 1
+        self.shrunk = set()
+        # Waves are built on a worker thread while the game loop releases dead NPCs
+        self.lock = threading.RLock()
+
+    def acquire(self, sprite_sheet_path, num_frames, scale):
+        with self.lock:
+            return self._acquire(sprite_sheet_path, num_frames, scale)
+
+    def _acquire(self, sprite_sheet_path, num_frames, scale):
+        if scale < self.render_scale and scale not in self.shrunk:
+            # Lossless only while render_scale is no bigger than the scale the sheet is asked for
+            self.shrunk.add(scale)
+            print(f"Sprites asked for at scale {scale} are loaded at {scale / self.render_scale:.2f}x their native "
+                  f"size with render scale {self.render_scale}, some of their pixel rows and columns are lost")
+        scale = scale / self.render_scale
+        key = (sprite_sheet_path, num_frames, scale)
+        if key not in self.entries:
+            frames = self.bundled.get(key)
+            if frames is None:
+                sprite_sheet = pygame.image.load(sprite_sheet_path).convert_alpha()
+                frames = AnimatedSprite._extract_frames(sprite_sheet, num_frames, scale)
+            self.entries[key] = {
+                "frames": frames,
+                "variants": {}
+            }
+            self.ref_counts[key] = 0
+        self.ref_counts[key] += 1
+        self.unused.pop(key, None)
+        return key, self.entries[key]
+
+    def release(self, key):
+        with self.lock:
+            self._release(key)
+
+    def _release(self, key):
+        if key not in self.ref_counts:
+            return
+        self.ref_counts[key] = max(0, self.ref_counts[key] - 1)
+        if self.ref_counts[key] == 0:
+            # Keep the last few unreferenced sheets around so the next wave doesn't hit the disk again
+            self.unused[key] = True
+            self.unused.move_to_end(key)
+            while len(self.unused) > self.max_unused:
+                evicted, _ = self.unused.popitem(last=False)
+                del self.entries[evicted]
+                del self.ref_counts[evicted]
+
+
+    def load_bundle(self, index_path=ASSET_BUNDLE_INDEX, pixels_path=ASSET_BUNDLE_PIXELS):
+        # Frames come out as subsurfaces of one memory mapped atlas, so nothing is decoded or scaled at startup
+        if not (os.path.exists(index_path) and os.path.exists(pixels_path)):
+            return False
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("format") != ASSET_BUNDLE_FORMAT:
+            print("The sprite atlas is out of date, rebuild it with --build-assets")
+            return False
+        with open(pixels_path, 'rb') as f:
+            # Copy on write, so drawing onto a frame can never touch the file or a read-only page
+            self.bundle_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        atlas = pygame.image.frombuffer(self.bundle_buffer, tuple(index["size"]), ASSET_BUNDLE_FORMAT)
+        display = pygame.display.get_surface()
+        if display is not None and display.get_masks()[:3] != atlas.get_masks()[:3]:
+            atlas = atlas.convert_alpha()  # A display with another pixel layout, convert once instead of per blit
+        for entry in index["animations"]:
+            # Skip sheets that changed since the bundle was built, they get loaded from the PNG instead
+            if not os.path.exists(entry["path"]) or os.path.getmtime(entry["path"]) != entry["mtime"]:
+                continue
+            key = (entry["path"], entry["num_frames"], entry["scale"])
+            self.bundled[key] = [atlas.subsurface(rect) for rect in entry["frames"]]
+        return True
+
+
+sprite_sheet_cache = SpriteSheetCache()
+
+
+def build_asset_bundle(index_path=ASSET_BUNDLE_INDEX, pixels_path=ASSET_BUNDLE_PIXELS, max_width=2048):
+    # Loads every animation the game uses at its final scale and shelf-packs all frames into one atlas
+    create_player().release()
+    release_npcs(create_npcs(SCREEN_WIDTH, SCREEN_HEIGHT, 1))
+    frames = [(key, i, frame) for key, entry in sprite_sheet_cache.entries.items()
+              for i, frame in enumerate(entry["frames"])]
+    frames.sort(key=lambda item: item[2].get_height(), reverse=True)
+
+    placements = {}
+    x = y = shelf_height = width = 0
+    for key, i, frame in frames:
+        if x + frame.get_width() > max_width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        placements[(key, i)] = (x, y, frame.get_width(), frame.get_height())
+        x += frame.get_width()
+        width = max(width, x)
+        shelf_height = max(shelf_height, frame.get_height())
+    height = y + shelf_height
+
+    atlas = pygame.Surface((width, height), pygame.SRCALPHA)
+    for key, i, frame in frames:
+        atlas.blit(frame, placements[(key, i)][:2])
+
+    animations = []
+    for key, entry in sprite_sheet_cache.entries.items():
+        path, num_frames, scale = key
+        animations.append({
+            "path": path,
+            "num_frames": num_frames,
+            "scale": scale,
+            "mtime": os.path.getmtime(path),
+            "frames": [placements[(key, i)] for i in range(len(entry["frames"]))]
+        })
+    with open(pixels_path, 'wb') as f:
+        f.write(pygame.image.tostring(atlas, ASSET_BUNDLE_FORMAT))
+    with open(index_path, 'w') as f:
+        json.dump({"size": [width, height], "format": ASSET_BUNDLE_FORMAT, "animations": animations}, f, indent=1)
+    return width, height
+
 
 class Entity:
     def __init__(self, sprite, collision_box):
@@ -93,6 +289,7 @@ class Entity:
         self.collision_box = collision_box
         self.delta_x = collision_box.x
         self.delta_y = collision_box.x
+        self.previous_position = (self.x_position, self.y_position)
 
     @property
     def x_position(self):
@@ -121,8 +318,13 @@ class Entity:
     def set_animation(self, name):
         self.sprite.set_animation(name)
 
-    def draw_sprite(self, screen, elapsed_time):
-        self.sprite.draw_sprite(screen, elapsed_time)
+    def store_previous_position(self):
+        self.previous_position = (self.x_position, self.y_position)
+
+    def interpolated_position(self, alpha):
+        previous_x, previous_y = self.previous_position
+        return (previous_x + (self.x_position - previous_x) * alpha,
+                previous_y + (self.y_position - previous_y) * alpha)
 
     def update_collision_box(self):
         self.collision_box.x = self.sprite.x_position + self.delta_x
@@ -137,6 +339,9 @@ class Entity:
     def get_current_animation(self):
         return self.sprite.current_animation
 
+    def release(self):
+        self.sprite.release()
+
 
 class Rectangle:
     def __init__(self, x, y, width, height):
@@ -154,12 +359,351 @@ class Rectangle:
         )
 
 
+class SpatialHash:
+    def __init__(self, cell_size=128):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entity_cells = {}
+
+    def _cell_keys(self, x, y, width, height):
+        size = self.cell_size
+        return [(cell_x, cell_y)
+                for cell_x in range(int(x // size), int((x + width) // size) + 1)
+                for cell_y in range(int(y // size), int((y + height) // size) + 1)]
+
+    def insert(self, entity):
+        box = entity.collision_box
+        keys = self._cell_keys(box.x, box.y, box.width, box.height)
+        for key in keys:
+            self.cells.setdefault(key, []).append(entity)
+        self.entity_cells[entity] = keys
+
+    def remove(self, entity):
+        for key in self.entity_cells.pop(entity, ()):
+            cell = self.cells[key]
+            cell.remove(entity)
+            if not cell:
+                del self.cells[key]
+
+    def rebuild(self, entities):
+        self.cells.clear()
+        self.entity_cells.clear()
+        for entity in entities:
+            self.insert(entity)
+
+    def _candidates(self, x, y, width, height):
+        found = {}
+        for key in self._cell_keys(x, y, width, height):
+            for entity in self.cells.get(key, ()):
+                found[entity] = True
+        return found
+
+    def query_rect(self, x, y, width, height):
+        area = Rectangle(x, y, width, height)
+        return [entity for entity in self._candidates(x, y, width, height)
+                if area.collides_with(entity.collision_box)]
+
+    def query_circle(self, center_x, center_y, radius):
+        hits = []
+        for entity in self._candidates(center_x - radius, center_y - radius, 2 * radius, 2 * radius):
+            box = entity.collision_box
+            # Distance from the circle center to the closest point of the box
+            nearest_x = min(max(center_x, box.x), box.x + box.width)
+            nearest_y = min(max(center_y, box.y), box.y + box.height)
+            if (center_x - nearest_x) ** 2 + (center_y - nearest_y) ** 2 < radius ** 2:
+                hits.append(entity)
+        return hits
+
+    def query_point(self, x, y):
+        return [entity for entity in self.cells.get((int(x // self.cell_size), int(y // self.cell_size)), ())
+                if entity.collision_box.x <= x < entity.collision_box.x + entity.collision_box.width and
+                entity.collision_box.y <= y < entity.collision_box.y + entity.collision_box.height]
+
+
+class SpriteBatch:
+    # Collects a frame's blits, sorts them once by layer and bottom edge and submits them with a single blits() call.
+    # Sprites on layer 0 can be scale times smaller than the world, for a scene rendered at low resolution.
+    # The layers above hold text, which is always drawn at screen resolution.
+    def __init__(self, scale=1):
+        self.items = []
+        self.scale = scale
+
+    def add(self, surface, position, layer=0):
+        height = surface.get_height() * self.scale if layer == 0 else surface.get_height()
+        self.items.append((layer, position[1] + height, surface, position))
+
+    def flush(self, screen, offset=(0, 0), layer=None):
+        # Draws everything queued, or only one layer, positions are in world coordinates and offset is the
+        # top left corner of the camera
+        items = self.items
+        items.sort(key=lambda item: (item[0], item[1]))
+        if layer is None:
+            self.items = []
+        else:
+            self.items = [item for item in items if item[0] != layer]
+            items = [item for item in items if item[0] == layer]
+        offset_x, offset_y = offset
+        if not (offset_x or offset_y) and self.scale == 1:
+            screen.blits([(surface, position) for _, _, surface, position in items], False)
+            return
+        blits = []
+        for item_layer, _, surface, (x, y) in items:
+            scale = self.scale if item_layer == 0 else 1
+            blits.append((surface, ((x - offset_x) / scale, (y - offset_y) / scale)))
+        screen.blits(blits, False)
+
+
+class NpcView:
+    # Entity-like handle on one slot of an NpcBatch, used by code that works on single NPCs
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def hp(self):
+        return int(self.batch.hp[self.index])
+
+    @hp.setter
+    def hp(self, value):
+        self.batch.hp[self.index] = value
+
+    @property
+    def x_position(self):
+        return float(self.batch.x[self.index])
+
+    @x_position.setter
+    def x_position(self, value):
+        self.batch.x[self.index] = value
+
+    @property
+    def y_position(self):
+        return float(self.batch.y[self.index])
+
+    @y_position.setter
+    def y_position(self, value):
+        self.batch.y[self.index] = value
+
+    @property
+    def flip_vertically(self):
+        return False
+
+    @property
+    def collision_box(self):
+        batch = self.batch
+        return Rectangle(float(batch.box_x[self.index]), float(batch.box_y[self.index]),
+                         batch.box_width, batch.box_height)
+
+    def set_animation(self, name):
+        pass
+
+    def interpolated_position(self, alpha):
+        batch, i = self.batch, self.index
+        return (float(batch.prev_x[i] + (batch.x[i] - batch.prev_x[i]) * alpha),
+                float(batch.prev_y[i] + (batch.y[i] - batch.prev_y[i]) * alpha))
+
+    def update_collision_box(self):
+        self.batch.update_collision_boxes(self.index)
+
+    def get_frame_width(self):
+        return self.batch.frames[0].get_width() * sprite_sheet_cache.render_scale
+
+    def get_frame_height(self):
+        return self.batch.frames[0].get_height() * sprite_sheet_cache.render_scale
+
+    def get_current_animation(self):
+        return 'default'
+
+    def release(self):
+        pass
+
+
+class NpcBatch:
+    # Struct-of-arrays storage for a wave of NPCs sharing one animation
+    def __init__(self, sprite_sheet_path, num_frames, frame_duration, scale, collision_box, capacity=64):
+        self.cache_key, entry = sprite_sheet_cache.acquire(sprite_sheet_path, num_frames, scale)
+        self.frames = entry["frames"]
+        self.num_frames = num_frames
+        self.frame_duration = frame_duration
+        self.delta_x = collision_box.x
+        self.delta_y = collision_box.x
+        self.box_width = collision_box.width
+        self.box_height = collision_box.height
+        self.count = 0
+        self.views = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        old_count = self.count
+        for name, dtype in (('x', np.float64), ('y', np.float64), ('prev_x', np.float64), ('prev_y', np.float64),
+                            ('box_x', np.float64), ('box_y', np.float64),
+                            ('hp', np.int32), ('phase', np.int32)):
+            array = np.zeros(capacity, dtype=dtype)
+            if old_count:
+                array[:old_count] = getattr(self, name)[:old_count]
+            setattr(self, name, array)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def add(self, x, y, hp=100, phase=0):
+        if self.count == len(self.x):
+            self._allocate(2 * len(self.x))
+        i = self.count
+        self.x[i] = self.prev_x[i] = x
+        self.y[i] = self.prev_y[i] = y
+        self.hp[i] = hp
+        self.phase[i] = phase
+        self.count += 1
+        view = NpcView(self, i)
+        self.views.append(view)
+        self.update_collision_boxes(i)
+        return view
+
+    def load(self, x, y, hp, phase):
+        # Replaces the whole wave with the given columns, used to show a snapshot from the simulation process
+        n = len(x)
+        if n > len(self.x):
+            self._allocate(n)
+        self.count = n
+        self.x[:n] = self.prev_x[:n] = x
+        self.y[:n] = self.prev_y[:n] = y
+        self.hp[:n] = hp
+        self.phase[:n] = phase
+        self.update_collision_boxes()
+        views = self.views
+        while len(views) < n:
+            views.append(NpcView(self, len(views)))
+        del views[n:]
+
+    def update_collision_boxes(self, index=None):
+        n = slice(0, self.count) if index is None else slice(index, index + 1)
+        self.box_x[n] = self.x[n] + self.delta_x
+        self.box_y[n] = self.y[n] + self.delta_y
+
+    def store_previous_positions(self):
+        n = self.count
+        self.prev_x[:n] = self.x[:n]
+        self.prev_y[:n] = self.y[:n]
+
+    def interpolated_positions(self, alpha):
+        n = self.count
+        if alpha >= 1:
+            return self.x[:n], self.y[:n]
+        return (self.prev_x[:n] + (self.x[:n] - self.prev_x[:n]) * alpha,
+                self.prev_y[:n] + (self.y[:n] - self.prev_y[:n]) * alpha)
+
+    def move_towards(self, target_x, target_y, speed):
+        n = self.count
+        self.x[:n] += np.sign(target_x - self.x[:n]) * speed
+        self.y[:n] += np.sign(target_y - self.y[:n]) * speed
+
+    def overlaps_rect(self, x, y, width, height):
+        n = self.count
+        return ((self.box_x[:n] < x + width) & (self.box_x[:n] + self.box_width > x) &
+                (self.box_y[:n] < y + height) & (self.box_y[:n] + self.box_height > y))
+
+    def overlaps_circle(self, center_x, center_y, radius):
+        n = self.count
+        nearest_x = np.clip(center_x, self.box_x[:n], self.box_x[:n] + self.box_width)
+        nearest_y = np.clip(center_y, self.box_y[:n], self.box_y[:n] + self.box_height)
+        return (center_x - nearest_x) ** 2 + (center_y - nearest_y) ** 2 < radius ** 2
+
+    def damage(self, mask, amount):
+        self.hp[:self.count][mask] -= amount
+
+    def remove_dead(self):
+        n = self.count
+        alive = self.hp[:n] > 0
+        remaining = int(np.count_nonzero(alive))
+        if remaining == n:
+            return
+        for name in ('x', 'y', 'prev_x', 'prev_y', 'box_x', 'box_y', 'hp', 'phase'):
+            array = getattr(self, name)
+            array[:remaining] = array[:n][alive]
+        self.views = [view for view, keep in zip(self.views, alive) if keep]
+        for i, view in enumerate(self.views):
+            view.index = i
+        self.count = remaining
+
+    def queue_sprites(self, sprite_batch, clock_ms, alpha=1.0, viewport=None):
+        # Queues the NPCs overlapping the viewport and returns their views
+        frames = self.frames
+        xs, ys = self.interpolated_positions(alpha)
+        visible = np.arange(self.count)
+        if viewport is not None:
+            width = frames[0].get_width() * sprite_sheet_cache.render_scale
+            height = frames[0].get_height() * sprite_sheet_cache.render_scale
+            visible = np.flatnonzero((xs < viewport.right) & (ys < viewport.bottom) &
+                                     (xs + width > viewport.left) & (ys + height > viewport.top))
+        frame_indices = (clock_ms + self.phase[visible]) // self.frame_duration % self.num_frames
+        for frame, x, y in zip(frame_indices.astype(np.int64).tolist(), xs[visible].tolist(), ys[visible].tolist()):
+            sprite_batch.add(frames[frame], (x, y))
+        views = self.views
+        return [views[i] for i in visible.tolist()]
+
+    def release(self):
+        if self.cache_key is not None:
+            sprite_sheet_cache.release(self.cache_key)
+            self.cache_key = None
+
+
+class ObjectPool:
+    # Keeps the live objects packed in a list and recycles dead ones through a free list
+    def __init__(self, factory, capacity):
+        self.factory = factory
+        self.capacity = capacity
+        self.items = []
+        self.free = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def spawn(self, *args):
+        if len(self.items) >= self.capacity:
+            return None
+        if self.free:
+            item = self.free.pop()
+            item.reset(*args)
+        else:
+            item = self.factory(*args)
+        self.items.append(item)
+        return item
+
+    def remove_if(self, predicate):
+        # Single pass compaction, keeps the draw order of the survivors
+        items = self.items
+        kept = 0
+        for item in items:
+            if predicate(item):
+                self.free.append(item)
+            else:
+                items[kept] = item
+                kept += 1
+        del items[kept:]
+
+    def clear(self):
+        self.free.extend(self.items)
+        self.items.clear()
+
+
 class Projectile:
+    __slots__ = ('rect', 'speed_x', 'speed_y')
+
     def __init__(self, x, y, width, height, speed_x, speed_y):
         self.rect = pygame.Rect(x, y, width, height)
         self.speed_x = speed_x
         self.speed_y = speed_y
 
+    def reset(self, x, y, width, height, speed_x, speed_y):
+        self.rect.update(x, y, width, height)
+        self.speed_x = speed_x
+        self.speed_y = speed_y
 
     def move_x(self):
         self.rect.x += self.speed_x
@@ -167,17 +711,52 @@ class Projectile:
     def move_y(self):
         self.rect.y += self.speed_y
 
-    def draw(self, screen):
-        pygame.draw.rect(screen, (0, 255, 0), self.rect)
+    def draw(self, screen, offset=(0, 0), alpha=1.0):
+        # Projectiles move by their speed every tick, so the previous position is one step back
+        back = 1 - alpha
+        screen.fill((0, 255, 0), self.rect.move(-offset[0] - int(self.speed_x * back),
+                                                -offset[1] - int(self.speed_y * back)))
+
+
+power_ball_frames = {}
+
+
+def get_power_ball_frames(initial_radius, max_radius, expansion_speed, color):
+    # Every radius a ball can be drawn with is known up front, so each one is rendered only once per process
+    key = (initial_radius, max_radius, expansion_speed, color)
+    frames = power_ball_frames.get(key)
+    if frames is None:
+        frames = {}
+        radius = initial_radius
+        while radius <= max_radius:
+            frames[radius] = render_power_ball_frame(radius, max_radius, color)
+            radius += expansion_speed
+        power_ball_frames[key] = frames
+    return frames
+
+
+def render_power_ball_frame(radius, max_radius, color):
+    surface = pygame.Surface((2 * max_radius, 2 * max_radius), pygame.SRCALPHA)
+    pygame.draw.circle(surface, color, (max_radius, max_radius), radius)
+    return surface
 
 
 class PowerBall:
+    __slots__ = ('x', 'y', 'radius', 'initial_radius', 'max_radius', 'expansion_speed', 'frames')
+    alpha = 80  # Adjust this value between 0 (completely transparent) and 255 (completely opaque)
+    color = (0, 255, 255, alpha)  # (R, G, B, Alpha)
+
     def __init__(self, x, y, initial_radius, max_radius, expansion_speed, offset_x=75, offset_y=70):
+        self.reset(x, y, initial_radius, max_radius, expansion_speed, offset_x, offset_y)
+
+    def reset(self, x, y, initial_radius, max_radius, expansion_speed, offset_x=75, offset_y=70):
         self.x = x + offset_x
         self.y = y + offset_y
         self.radius = initial_radius
+        self.initial_radius = initial_radius
         self.max_radius = max_radius
         self.expansion_speed = expansion_speed
+        self.frames = get_power_ball_frames(initial_radius, max_radius, expansion_speed, self.color)
 
     def expand(self):
         self.radius += self.expansion_speed
@@ -185,14 +764,12 @@ class PowerBall:
             return True  # Indicates that the power ball has reached its maximum radius
         return False
 
-    def draw(self, screen):
-        #pygame.draw.circle(screen, (255, 0, 0), (int(self.x), int(self.y)), self.radius, 2)
-        alpha = 80  # Adjust this value between 0 (completely transparent) and 255 (completely opaque)
-        color = (0, 255, 255, alpha) # (R, G, B, Alpha)
-
-        surface = pygame.Surface((2 * self.max_radius, 2 * self.max_radius), pygame.SRCALPHA)
-        pygame.draw.circle(surface, color, (self.max_radius, self.max_radius), self.radius)
-        screen.blit(surface, (int(self.x) - self.max_radius, int(self.y) - self.max_radius))
+    def draw(self, screen, offset=(0, 0)):
+        surface = self.frames.get(self.radius)
+        if surface is None:
+            surface = render_power_ball_frame(self.radius, self.max_radius, self.color)
+            self.frames[self.radius] = surface
+        screen.blit(surface, (int(self.x) - self.max_radius - offset[0], int(self.y) - self.max_radius - offset[1]))
 
 
 class PowerBar:
@@ -216,17 +793,49 @@ class PowerBar:
         # Calculate the width of the filled portion of the power bar
         fill_width = int(width * fill_percentage)
 
-        # Draw the power bar outline
-        pygame.draw.rect(screen, (255, 255, 255), (x, y, width, height), 2)
+        # Draw the power bar outline, 2px wide
+        for edge in ((x, y, width, 2), (x, y + height - 2, width, 2), (x, y, 2, height), (x + width - 2, y, 2, height)):
+            screen.fill((255, 255, 255), edge)
 
         # Draw the filled portion of the power bar
-        pygame.draw.rect(screen, (0, 255, 0), (x, y, fill_width, height))
+        screen.fill((0, 255, 0), (x, y, fill_width, height))
+
+
+class TextRenderer:
+    def __init__(self, font_name='freesansbold.ttf', max_cached=256):
+        self.font_name = font_name
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+        self.max_cached = max_cached
+
+    def get_font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font = pygame.font.Font(self.font_name, size)
+            self.fonts[size] = font
+        return font
+
+    def render(self, text, size, color):
+        key = (text, size, tuple(color))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = self.get_font(size).render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_cached:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+text_renderer = TextRenderer()
 
 
 @dataclass
 class Level:
     npcs: int
     stage: int
+    npc_backend: str = None
 
 def move_towards(target, current, speed):
     delta = target - current
@@ -237,87 +846,213 @@ def move_towards(target, current, speed):
     return 0
 
 
-def draw_tiles(screen, terrain, SCREEN_WIDTH, SCREEN_HEIGHT):
-    tile_width = terrain.get_width()
-    tile_height = terrain.get_height()
-    for i in range(0, SCREEN_WIDTH, tile_width):
-        for j in range(0, SCREEN_HEIGHT, tile_height):
-            screen.blit(terrain, (i, j))
+class Camera:
+    # The part of the world shown on screen, in world coordinates
+    def __init__(self, width, height, world_width, world_height):
+        self.rect = pygame.Rect(0, 0, width, height)
+        self.bounds = pygame.Rect(0, 0, world_width, world_height)
 
-
-def draw_hp(entity, screen, delta_x=30, delta_y=30, font_color=(0, 0, 0)):
-    font = pygame.font.Font('freesansbold.ttf', 14)
-    text = font.render(f'HP: {entity.hp}', True, font_color)
+    @property
+    def offset(self):
+        return self.rect.topleft
+
+    def follow(self, x, y):
+        # Centers on (x, y) without showing anything past the edges of the world
+        self.rect.center = (int(x), int(y))
+        self.rect.clamp_ip(self.bounds)
+
+    def to_world(self, pos):
+        return pos[0] + self.rect.x, pos[1] + self.rect.y
+
+
+class TileMap:
+    # Tiles the world with terrain and cuts it into square chunks. A chunk is composited into a single surface
+    # the first time the camera gets to it and the least recently used ones are dropped, so a big world costs
+    # memory only for the area around the camera and drawing the background is a few blits.
+    def __init__(self, terrain, world_width, world_height, chunk_size=512, max_chunks=16):
+        self.terrain = terrain
+        self.bounds = pygame.Rect(0, 0, world_width, world_height)
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+
+    def chunk(self, cx, cy):
+        key = (cx, cy)
+        surface = self.chunks.get(key)
+        if surface is not None:
+            self.chunks.move_to_end(key)
+            return surface
+        size = self.chunk_size
+        left, top = cx * size, cy * size
+        surface = pygame.Surface((min(size, self.bounds.width - left), min(size, self.bounds.height - top))).convert()
+        tile_width, tile_height = self.terrain.get_size()
+        # Tiles are laid out from the world origin, so they line up across chunk borders
+        for x in range(left - left % tile_width, left + surface.get_width(), tile_width):
+            for y in range(top - top % tile_height, top + surface.get_height(), tile_height):
+                surface.blit(self.terrain, (x - left, y - top))
+        self.chunks[key] = surface
+        if len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return surface
+
+    def draw(self, screen, view, area=None):
+        # view is the camera rect, area the part of the screen to cover (all of it by default)
+        if area is None:
+            area = pygame.Rect(0, 0, view.width, view.height)
+        world_area = area.move(view.x, view.y).clip(self.bounds)
+        if not world_area:
+            return
+        size = self.chunk_size
+        for cx in range(world_area.left // size, (world_area.right - 1) // size + 1):
+            for cy in range(world_area.top // size, (world_area.bottom - 1) // size + 1):
+                chunk = self.chunk(cx, cy)
+                part = world_area.clip(cx * size, cy * size, chunk.get_width(), chunk.get_height())
+                screen.blit(chunk, (part.x - view.x, part.y - view.y), part.move(-cx * size, -cy * size))
+
+
+class DirtyRectScreen:
+    # Wraps the display surface and remembers the area touched by every blit and fill
+    def __init__(self, surface):
+        self.surface = surface
+        self.rects = []
+
+    def __getattr__(self, name):
+        return getattr(self.surface, name)
+
+    def blit(self, source, dest, area=None, special_flags=0):
+        rect = self.surface.blit(source, dest, area, special_flags)
+        self.rects.append(rect)
+        return rect
+
+    def blits(self, blit_sequence, doreturn=1):
+        rects = self.surface.blits(blit_sequence, True)
+        self.rects.extend(rects)
+        return rects if doreturn else None
+
+    def fill(self, color, rect=None, special_flags=0):
+        rect = self.surface.fill(color, rect, special_flags)
+        self.rects.append(rect)
+        return rect
+
+
+def draw_hp(entity, screen, delta_x=30, delta_y=30, font_color=(0, 0, 0), position=None, sprite_batch=None):
+    x, y = position or (entity.x_position, entity.y_position)
+    text = text_renderer.render(f'HP: {entity.hp}', 14, font_color)
     text_rect = text.get_rect()
-    text_rect.center = (entity.x_position + delta_x, entity.y_position + delta_y)
-    screen.blit(text, text_rect)
+    text_rect.center = (x + delta_x, y + delta_y)
+    if sprite_batch is not None:
+        sprite_batch.add(text, text_rect.topleft, layer=1)
+    else:
+        screen.blit(text, text_rect)
 
 
 def check_game_over(player, screen, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=(255, 255, 255)):
+    # screen may be None when only the game state should be updated
     if player.hp <= 0:
-        font = pygame.font.Font('freesansbold.ttf', 32)
-        text = font.render('GAME OVER', True, font_color)
-        textRect = text.get_rect()
-        textRect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
-        screen.blit(text, textRect)
+        if screen is not None:
+            draw_game_over(screen, SCREEN_WIDTH, SCREEN_HEIGHT, font_color)
         player.set_animation('defeated')
 
 
-def next_level(level, start_time, duration, npcs, screen, power_bar, SCREEN_WIDTH=600, SCREEN_HEIGHT=600, font_color=(255, 255, 255)):
-    time_elapsed = time.time() - start_time
-    if time_elapsed > duration or len(npcs) == 0:
-        font = pygame.font.Font('freesansbold.ttf', 32)
-        text = font.render(str(level.stage), True, font_color)
-        textRect = text.get_rect()
-        textRect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
-        screen.blit(text, textRect)
+def draw_game_over(screen, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=(255, 255, 255)):
+    text = text_renderer.render('GAME OVER', 32, font_color)
+    textRect = text.get_rect()
+    textRect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
+    screen.blit(text, textRect)
+
+
+def next_level(level, expired, npcs, screen, power_bar, SCREEN_WIDTH=600, SCREEN_HEIGHT=600,
+               font_color=(255, 255, 255), waves=None):
+    # expired is set by the level timer, screen may be None when only the game state should be updated
+    advanced = expired or (len(npcs) == 0 and not (waves and waves.spawning))
+    if advanced and waves is not None and not waves.ready(level.npcs + 4):
+        # The next wave is still being built, keep the current level for another tick
+        advanced = False
+    if advanced:
+        if screen is not None:
+            text = text_renderer.render(str(level.stage), 32, font_color)
+            textRect = text.get_rect()
+            textRect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
+            screen.blit(text, textRect)
         level.stage += 1
         level.npcs += 4
-        npcs = create_npcs(SCREEN_WIDTH, SCREEN_HEIGHT, level.npcs)
-        start_time = time.time()
+        release_npcs(npcs)
+        if waves is not None:
+            npcs = waves.start_wave(level.npcs)
+            waves.prepare(level.npcs + 4)
+        else:
+            npcs = create_npcs(SCREEN_WIDTH, SCREEN_HEIGHT, level.npcs, level.npc_backend)
         power_bar.increase_power(100)
-    # display level for 2 seconds
-    if time.time() - start_time < 2:
-        font = pygame.font.Font('freesansbold.ttf', 32)
-        text = font.render(f"Level {level.stage}", True, font_color)
-        textRect = text.get_rect()
-        textRect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
-        screen.blit(text, textRect)
-    return start_time, level, npcs
-
-
-def render_time_remaining(screen, start_time, SCREEN_WIDTH, duration=60, font_color=(255, 255, 255)):
-    time_elapsed = time.time() - start_time
-    remaining_time = max(0, duration - time_elapsed)
+    return advanced, level, npcs
+
+
+def draw_level_banner(screen, level, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=(255, 255, 255)):
+    text = text_renderer.render(f"Level {level.stage}", 32, font_color)
+    textRect = text.get_rect()
+    textRect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
+    screen.blit(text, textRect)
+
+
+def render_time_remaining(screen, remaining_time, SCREEN_WIDTH, font_color=(255, 255, 255)):
+    remaining_time = max(0, remaining_time)
     remaining_time_in_minutes = int(remaining_time // 60)
     remaining_time_in_seconds = int(remaining_time % 60)
     remaining_time_in_seconds = str(remaining_time_in_seconds).zfill(2)
     remaining_time_in_minutes = str(remaining_time_in_minutes).zfill(2)
-    font = pygame.font.Font('freesansbold.ttf', 14)
-    text = font.render(f'Time {remaining_time_in_minutes}:{remaining_time_in_seconds}', True, font_color)
+    text = text_renderer.render(f'Time {remaining_time_in_minutes}:{remaining_time_in_seconds}', 14, font_color)
     textRect = text.get_rect()
     textRect.center = (SCREEN_WIDTH - 100, 30)
     screen.blit(text, textRect)
 
 
-def check_colision_with_projectile(projectiles, npcs):
-    for projectile in projectiles.copy():
-        for npc in npcs:
-            if projectile.rect.colliderect(npc.collision_box.x, npc.collision_box.y, npc.collision_box.width,
-                                           npc.collision_box.height):
+def build_npc_grid(npcs):
+    if isinstance(npcs, NpcBatch):
+        return None  # The batch tests overlaps against its arrays directly
+    npc_grid = SpatialHash()
+    npc_grid.rebuild(npcs)
+    return npc_grid
+
+
+def check_colision_with_projectile(projectiles, npcs, npc_grid=None):
+    if isinstance(npcs, NpcBatch):
+        def hit(projectile):
+            hits = npcs.overlaps_rect(projectile.rect.x, projectile.rect.y, projectile.rect.width,
+                                      projectile.rect.height)
+            if hits.any():
+                npcs.damage(hits, 10)
+                return True
+            return False
+    else:
+        if npc_grid is None:
+            npc_grid = build_npc_grid(npcs)
+
+        def hit(projectile):
+            hits = npc_grid.query_rect(projectile.rect.x, projectile.rect.y, projectile.rect.width,
+                                       projectile.rect.height)
+            for npc in hits:
                 npc.hp -= 10  # Reduz a HP do NPC quando atingido
-                if projectile in projectiles:
-                    projectiles.remove(projectile)  # Remove o projétil após colidir com um NPC
+            return bool(hits)
+
+    projectiles.remove_if(hit)  # Remove o projétil após colidir com um NPC
 
 
-def move_projectile(projectiles, screen):
+def move_projectile(projectiles, screen=None):
     for projectile in projectiles:
         projectile.move_x()
         projectile.move_y()
-        projectile.draw(screen)
+        if screen is not None:
+            projectile.draw(screen)
+
+
+def draw_projectiles(projectiles, screen, offset=(0, 0), alpha=1.0):
+    for projectile in projectiles:
+        projectile.draw(screen, offset, alpha)
 
 
 def move_npcs(npcs, player):
+    if isinstance(npcs, NpcBatch):
+        npcs.move_towards(player.x_position, player.y_position, 1)
+        return
     for npc in npcs:
         delta_x = move_towards(player.x_position, npc.x_position, 1)
         delta_y = move_towards(player.y_position, npc.y_position, 1)
@@ -326,74 +1061,237 @@ def move_npcs(npcs, player):
         npc.y_position += delta_y
 
 
-def draw_npcs(npcs, screen, elapsed_time):
+def draw_npcs(npcs, screen, clock_ms, alpha=1.0, sprite_batch=None, viewport=None):
+    # NPC animations are clips on the shared clock_ms, alpha < 1 draws them between their last two positions.
+    # With a sprite_batch the blits are only queued, otherwise they are submitted here.
+    # NPCs outside the viewport get neither a sprite, an HP label nor an animation frame lookup, and since
+    # clips have no per-NPC state they pick up at the right frame once they come back into view.
+    batch = sprite_batch if sprite_batch is not None else SpriteBatch()
+    if viewport is None:
+        viewport = screen.get_rect()
+    if isinstance(npcs, NpcBatch):
+        for npc in npcs.queue_sprites(batch, clock_ms, alpha, viewport):
+            draw_hp(npc, screen, delta_x=50, delta_y=50,
+                    position=npc.interpolated_position(alpha) if alpha < 1 else None, sprite_batch=batch)
+    else:
+        left, top, right, bottom = viewport.left, viewport.top, viewport.right, viewport.bottom
+        for npc in npcs:
+            x, y = npc.interpolated_position(alpha) if alpha < 1 else (npc.x_position, npc.y_position)
+            if x >= right or y >= bottom or x + npc.get_frame_width() <= left or y + npc.get_frame_height() <= top:
+                continue
+            batch.add(npc.sprite.clip_surface(clock_ms), (x, y))
+            draw_hp(npc, screen, delta_x=50, delta_y=50, position=(x, y), sprite_batch=batch)
+    if sprite_batch is None:
+        batch.flush(screen)
+
+
+def apply_damage_to_player(player, npcs, npc_grid=None):
+    if isinstance(npcs, NpcBatch):
+        box = player.collision_box
+        hits = int(np.count_nonzero(npcs.overlaps_rect(box.x, box.y, box.width, box.height)))
+        if player.hp > 0:
+            player.hp -= min(hits, player.hp)
+        return
+    if npc_grid is None:
+        npc_grid = build_npc_grid(npcs)
+    box = player.collision_box
+    for npc in npc_grid.query_rect(box.x, box.y, box.width, box.height):
+        if player.hp > 0:
+            player.hp -= 1
+
+
+def remove_dead_npcs(npcs, npc_grid=None):
+    if isinstance(npcs, NpcBatch):
+        npcs.remove_dead()
+        return
+    alive = []
     for npc in npcs:
-        npc.draw_sprite(screen, elapsed_time)
-        draw_hp(npc, screen, delta_x=50, delta_y=50)
-        # pygame.draw.rect(screen, (0, 0, 255),
-        #                  (npc.collision_box.x, npc.collision_box.y, npc.collision_box.width, npc.collision_box.height),
-        #                  2)
-
-
-def apply_damage_to_player(player, npcs):
+        if npc.hp <= 0:
+            npc.release()
+            if npc_grid is not None:
+                npc_grid.remove(npc)
+        else:
+            alive.append(npc)
+    npcs[:] = alive
+
+
+def release_npcs(npcs):
+    if isinstance(npcs, NpcBatch):
+        npcs.release()
+        return
     for npc in npcs:
-        if player.collision_box.collides_with(npc.collision_box):
-            if player.hp > 0:
-                player.hp -= 1
+        npc.release()
 
 
-def remove_dead_npcs(npcs):
-    for npc in npcs.copy():
-        if npc.hp <= 0:
-            npcs.remove(npc)
+def store_previous_positions(npcs):
+    if isinstance(npcs, NpcBatch):
+        npcs.store_previous_positions()
+        return
+    for npc in npcs:
+        npc.store_previous_position()
 
 
 def update_npc_collision_box(npcs):
+    if isinstance(npcs, NpcBatch):
+        npcs.update_collision_boxes()
+        return
     for npc in npcs:
         npc.update_collision_box()
 
 
-def handle_events(player, idle_time, pygame, projectiles, power_balls, power_bar):
-    for event in pygame.event.get():
+@dataclass
+class InputFrame:
+    events: list
+    keys: object
+    mouse_pos: tuple
+
+
+class PressedKeys:
+    # Stands in for pygame.key.get_pressed() when input does not come from a real keyboard
+    def __init__(self, pressed=()):
+        self.pressed = set(pressed)
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+def read_input(pygame):
+    return InputFrame(pygame.event.get(), pygame.key.get_pressed(), pygame.mouse.get_pos())
+
+
+RECORDED_KEYS = [pygame.K_d, pygame.K_RIGHT, pygame.K_a, pygame.K_LEFT, pygame.K_s, pygame.K_DOWN, pygame.K_w, pygame.K_UP]
+REPLAY_HEADER = struct.Struct('<4sBQdHBHH')
+REPLAY_TICK = struct.Struct('<BB')
+REPLAY_EVENT = struct.Struct('<Bhh')
+REPLAY_MAGIC = b'VRPL'
+REPLAY_VERSION = 2
+EVENT_LEFT_CLICK = 1
+EVENT_RIGHT_CLICK = 3
+EVENT_TOGGLE_OVERLAY = 4
+
+
+def encode_input_frame(input_frame):
+    # One key bitmask byte and an event count, plus 5 bytes per click or key press
+    key_mask = 0
+    for bit, key in enumerate(RECORDED_KEYS):
+        if input_frame.keys[key]:
+            key_mask |= 1 << bit
+    events = []
+    x, y = input_frame.mouse_pos
+    for event in input_frame.events:
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button in (EVENT_LEFT_CLICK, EVENT_RIGHT_CLICK):
+            events.append(REPLAY_EVENT.pack(event.button, x, y))
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            events.append(REPLAY_EVENT.pack(EVENT_TOGGLE_OVERLAY, x, y))
+    return REPLAY_TICK.pack(key_mask, len(events)) + b''.join(events)
+
+
+def decode_input_frame(data, offset=0, mouse_pos=(0, 0)):
+    # Returns the InputFrame starting at offset and the offset of the next one
+    key_mask, event_count = REPLAY_TICK.unpack_from(data, offset)
+    offset += REPLAY_TICK.size
+    events = []
+    for _ in range(event_count):
+        code, x, y = REPLAY_EVENT.unpack_from(data, offset)
+        offset += REPLAY_EVENT.size
+        mouse_pos = (x, y)
+        if code == EVENT_TOGGLE_OVERLAY:
+            events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_F3))
+        else:
+            events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=code, pos=mouse_pos))
+    keys = PressedKeys(key for bit, key in enumerate(RECORDED_KEYS) if key_mask & (1 << bit))
+    return InputFrame(events, keys, mouse_pos), offset
+
+
+class InputRecorder:
+    # Writes the seed and the input of every simulation tick to a compact binary log
+    def __init__(self, path, seed, tick_ms, num_npcs, npc_backend=None, world_size=None):
+        world_width, world_height = world_size or (SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.file = open(path, 'wb')
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, seed, tick_ms, num_npcs,
+                                           1 if npc_backend == 'numpy' else 0, world_width, world_height))
+
+    def record(self, input_frame):
+        self.file.write(encode_input_frame(input_frame))
+
+    def close(self):
+        self.file.close()
+
+
+class InputReplay:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version = struct.unpack_from('<4sB', data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"{path} is not a version {REPLAY_VERSION} replay")
+        _, _, self.seed, self.tick_ms, self.num_npcs, backend, world_width, world_height = \
+            REPLAY_HEADER.unpack_from(data)
+        self.npc_backend = 'numpy' if backend else None
+        self.world_size = (world_width, world_height)
+        self.frames = []
+        offset = REPLAY_HEADER.size
+        mouse_pos = (0, 0)
+        while offset < len(data):
+            input_frame, offset = decode_input_frame(data, offset, mouse_pos)
+            mouse_pos = input_frame.mouse_pos
+            self.frames.append(input_frame)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def script(self, tick, game):
+        return self.frames[tick]
+
+
+
+def handle_events(player, timers, idle_timer, pygame, projectiles, power_balls, power_bar, input_frame=None,
+                  audio=None):
+    # Any action pushes idle_timer back, when it fires the player goes back to the idle animation
+    if input_frame is None:
+        input_frame = read_input(pygame)
+    for event in input_frame.events:
         if event.type == pygame.QUIT:
             pygame.quit()
             sys.exit()
         elif player.get_current_animation() == 'defeated':
             continue
         elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:  # Botão esquerdo do mouse
-            idle_time = time.time()
-            pos = pygame.mouse.get_pos()
+            timers.reschedule(idle_timer, IDLE_DELAY)
+            pos = input_frame.mouse_pos
             if pos[0] < player.x_position:
-                projectile = Projectile(int(player.x_position) + 50,
-                                        int(player.y_position) + 70, 10, 10, -10, 0)
+                projectiles.spawn(int(player.x_position) + 50,
+                                  int(player.y_position) + 70, 10, 10, -10, 0)
 
             elif player.get_current_animation() == 'front':
-                projectile = Projectile(int(player.x_position) + 70,
-                                        int(player.y_position) + 70, 10, 10, 0, 10)
+                projectiles.spawn(int(player.x_position) + 70,
+                                  int(player.y_position) + 70, 10, 10, 0, 10)
             elif player.get_current_animation() == 'back':
-                projectile = Projectile(int(player.x_position) + 70,
-                                        int(player.y_position) + 70, 10, 10, 0, -10)
+                projectiles.spawn(int(player.x_position) + 70,
+                                  int(player.y_position) + 70, 10, 10, 0, -10)
             else:
-                projectile = Projectile(int(player.x_position) + 70,
-                                        int(player.y_position) + 70, 10, 10, 10, 0)
-            projectiles.append(projectile)
+                projectiles.spawn(int(player.x_position) + 70,
+                                  int(player.y_position) + 70, 10, 10, 10, 0)
+            if audio is not None:
+                audio.play('shot')
         elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:  # Right mouse button for special power
             if power_bar.get_power_level() >= 100:
-                idle_time = time.time()
-                pos = pygame.mouse.get_pos()
-                power_ball = PowerBall(player.x_position, player.y_position, 10, 130, 10)
-                power_balls.append(power_ball)
+                timers.reschedule(idle_timer, IDLE_DELAY)
+                pos = input_frame.mouse_pos
+                power_balls.spawn(player.x_position, player.y_position, 10, 130, 10)
                 power_bar.decrease_power(100)
+                if audio is not None:
+                    audio.play('power_ball')
 
     if player.get_current_animation() == 'defeated':
-        return idle_time
+        return
 
-    keys = pygame.key.get_pressed()
+    keys = input_frame.keys
 
     # if key is pressed
     if keys[pygame.K_d] or keys[pygame.K_RIGHT] or keys[pygame.K_a] or \
             keys[pygame.K_LEFT] or keys[pygame.K_s] or keys[pygame.K_DOWN] or keys[pygame.K_w] or keys[pygame.K_UP]:
-        idle_time = time.time()
+        timers.reschedule(idle_timer, IDLE_DELAY)
 
     if keys[pygame.K_d] or keys[pygame.K_RIGHT]:
         player.x_position += 5
@@ -412,44 +1310,116 @@ def handle_events(player, idle_time, pygame, projectiles, power_balls, power_bar
         player.y_position -= 5
         player.set_animation('back')
 
-    if time.time() - idle_time > 0.3 and player.get_current_animation() != 'defeated':
-        player.set_animation('idle')
-
-    return idle_time
 
+def check_collision_with_power_balls(power_balls, npcs, npc_grid=None):
+    if npc_grid is None and not isinstance(npcs, NpcBatch):
+        npc_grid = build_npc_grid(npcs)
 
-def check_collision_with_power_balls(power_balls, npcs):
-    for power_ball in power_balls.copy():
-        for npc in npcs.copy():
-            power_ball_rect = pygame.Rect(
-                power_ball.x - power_ball.radius,
-                power_ball.y - power_ball.radius,
-                2 * power_ball.radius,
-                2 * power_ball.radius
-            )
-            if power_ball_rect.colliderect(npc.collision_box.x, npc.collision_box.y, npc.collision_box.width,
-                                            npc.collision_box.height):
+    def hit_and_expand(power_ball):
+        if isinstance(npcs, NpcBatch):
+            npcs.damage(npcs.overlaps_circle(power_ball.x, power_ball.y, power_ball.radius), 20)
+        else:
+            for npc in npc_grid.query_circle(power_ball.x, power_ball.y, power_ball.radius):
                 npc.hp -= 20
+        return power_ball.expand()  # Remove the power ball if it has reached its maximum radius
 
-        if power_ball.expand():
-            power_balls.remove(power_ball)  # Remove the power ball if it has reached its maximum radius
+    power_balls.remove_if(hit_and_expand)
 
 
-def draw_power_balls(power_balls, screen):
+def draw_power_balls(power_balls, screen, offset=(0, 0)):
     for power_ball in power_balls:
-        power_ball.draw(screen)
-
-
-def remove_projectile_out_of_screen(projectiles, SCREEN_WIDTH, SCREEN_HEIGHT):
-    for projectile in projectiles.copy():
-        if projectile.rect.x > SCREEN_WIDTH or projectile.rect.x < 0 or projectile.rect.y > SCREEN_HEIGHT or projectile.rect.y < 0:
-            projectiles.remove(projectile)
-
-
-def play_game_music(pygame):
-    pygame.mixer.init()
-    pygame.mixer.music.load('dracula.mp3')  # Replace with the actual path to your music file
-    pygame.mixer.music.play(-1)  # -1 means the music will loop indefinitely
+        power_ball.draw(screen, offset)
+
+
+def remove_projectiles_out_of_bounds(projectiles, bounds):
+    # bounds is in world coordinates, usually the part of the world around the camera
+    left, top, right, bottom = bounds.left, bounds.top, bounds.right, bounds.bottom
+    projectiles.remove_if(lambda projectile: projectile.rect.x > right or projectile.rect.x < left or
+                          projectile.rect.y > bottom or projectile.rect.y < top)
+
+
+SOUND_EFFECTS = {
+    # name: (file, tone used when the file is missing in Hz, tone length in ms)
+    'shot': ('assets/shot.wav', 880, 60),
+    'power_ball': ('assets/power_ball.wav', 220, 250),
+}
+AUDIO_CHANNELS = 8
+
+
+def synth_tone(frequency, duration_ms, volume=0.25):
+    # Square wave fading out, stands in for effect files that are not in the repo
+    rate, _, channels = pygame.mixer.get_init()
+    length = rate * duration_ms // 1000
+    half_period = max(1, int(rate / frequency / 2))
+    samples = array('h')
+    for i in range(length):
+        value = int(32767 * volume * (1 - i / length))
+        samples.extend([value if (i // half_period) % 2 else -value] * channels)
+    return pygame.mixer.Sound(buffer=samples.tobytes())
+
+
+class AudioSystem:
+    # Opens the mixer, decodes the effects and starts the music on a background thread, so the first frame
+    # never waits on the audio device or the mp3. Effects play on a fixed set of channels: when they are
+    # all busy the one started longest ago is cut off, so a burst of shots never allocates or blocks.
+    def __init__(self, music_path='dracula.mp3', effects=SOUND_EFFECTS, num_channels=AUDIO_CHANNELS):
+        self.music_path = music_path
+        self.effects = effects
+        self.num_channels = num_channels
+        self.sounds = {}
+        self.channels = []
+        self.next_channel = 0
+        self.ready = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._load, daemon=True)
+        self.thread.start()
+        return self
+
+    def _load(self):
+        try:
+            pygame.mixer.init(44100, -16, 2, 512)
+        except pygame.error as e:
+            print(f"No audio: {e}")
+            return
+        pygame.mixer.set_num_channels(self.num_channels)
+        sounds = {}
+        for name, (path, frequency, duration_ms) in self.effects.items():
+            try:
+                sounds[name] = pygame.mixer.Sound(path)
+            except (pygame.error, FileNotFoundError):
+                sounds[name] = synth_tone(frequency, duration_ms)
+        self.sounds = sounds
+        self.channels = [pygame.mixer.Channel(i) for i in range(self.num_channels)]
+        self.ready = True
+
+        try:
+            pygame.mixer.music.load(self.music_path)  # music is streamed from disk while it plays
+            pygame.mixer.music.play(-1)  # -1 means the music will loop indefinitely
+        except (pygame.error, FileNotFoundError) as e:
+            print(f"Could not play {self.music_path}: {e}")
+
+    def play(self, name):
+        # Silently does nothing until the background load has finished
+        if not self.ready:
+            return
+        sound = self.sounds.get(name)
+        if sound is None:
+            return
+        channels = self.channels
+        count = len(channels)
+        start = self.next_channel
+        # Channels are handed out in turn, so the first busy one from here was started longest ago
+        for offset in range(count):
+            channel = channels[(start + offset) % count]
+            if not channel.get_busy():
+                break
+        else:
+            offset = 0
+            channel = channels[start]
+        self.next_channel = (start + offset + 1) % count
+        channel.play(sound)
 
 
 def update_power_bar(power_bar, elapsed_time):
@@ -470,88 +1440,1029 @@ def create_player():
     return player
 
 
-def create_npcs(screen_width, screen_height, num_npcs):
-    nosferatu_sprite = AnimatedSprite()
-    nosferatu_sprite.add_animation('default', 'assets/nosferatu.png', 4, 150, 2)
-    nosferatus = [Entity(AnimatedSprite(), Rectangle(0, 0, 60, 80)) for _ in range(num_npcs)]
-    for nosferatu in nosferatus:
+def create_npcs(screen_width, screen_height, num_npcs, backend=None):
+    if backend == 'numpy':
+        if np is not None:
+            npcs = NpcBatch('assets/nosferatu.png', 4, 150, 2, Rectangle(60, 0, 60, 80), capacity=max(num_npcs, 1))
+            for _ in range(num_npcs):
+                npcs.add(random.randint(0, screen_width), random.randint(0, screen_height),
+                         phase=random.randrange(4 * 150))
+            return npcs
+        print("NumPy is not installed, falling back to the default NPC backend")
+    npc_collision_box = Rectangle(60, 0, 60, 80)
+    npcs = [Entity(AnimatedSprite(), copy.copy(npc_collision_box)) for _ in range(num_npcs)]
+    for nosferatu in npcs:
         nosferatu.sprite.add_animation('default', 'assets/nosferatu.png', 4, 150, 2)
+        nosferatu.set_animation('default')
         nosferatu.x_position = random.randint(0, screen_width)
         nosferatu.y_position = random.randint(0, screen_height)
-    npc_collision_box = Rectangle(60, 0, 60, 80)
-    npcs = [Entity(nosferatu_sprite, copy.copy(npc_collision_box)) for nosferatu_sprite in nosferatus]
+        nosferatu.store_previous_position()
+        # Every nosferatu plays the same clip, the phase keeps them from walking in lockstep
+        nosferatu.sprite.phase = random.randrange(4 * 150)
     return npcs
 
 
+class WaveLoader:
+    # Builds the next wave on a worker thread during the current level, then hands its NPCs to the game a fixed
+    # spawn_per_tick at a time. With wait=False a level only ends once the worker is done, so the game thread never
+    # blocks on it; wait=True blocks instead, which keeps headless runs and recordings deterministic.
+    def __init__(self, screen_width, screen_height, backend=None, spawn_per_tick=8, wait=True):
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.backend = backend
+        self.spawn_per_tick = spawn_per_tick
+        self.wait = wait
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='wave-loader')
+        self.next_wave = None
+        self.next_wave_size = None
+        self.pending = []
+
+    @property
+    def spawning(self):
+        return bool(self.pending)
+
+    def prepare(self, num_npcs):
+        self.next_wave_size = num_npcs
+        self.next_wave = self.executor.submit(create_npcs, self.screen_width, self.screen_height, num_npcs,
+                                              self.backend)
+
+    def ready(self, num_npcs):
+        if self.next_wave is None or self.next_wave_size != num_npcs:
+            self.discard()
+            self.prepare(num_npcs)
+        return self.wait or self.next_wave.done()
+
+    def discard(self):
+        if self.next_wave is not None:
+            self.next_wave.add_done_callback(lambda future: release_npcs(future.result()))
+            self.next_wave = None
+
+    def start_wave(self, num_npcs):
+        release_npcs(self.pending)
+        self.ready(num_npcs)
+        wave = self.next_wave.result()
+        self.next_wave = None
+        if isinstance(wave, NpcBatch):
+            # Adding rows to the arrays is cheap, the whole batch goes live at once
+            self.pending = []
+            return wave
+        self.pending = wave[::-1]
+        return []
+
+    def spawn(self, npcs):
+        for _ in range(min(self.spawn_per_tick, len(self.pending))):
+            npcs.append(self.pending.pop())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
 def display_level(screen, level, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=(255, 255, 255)):
-    font = pygame.font.Font('freesansbold.ttf', 14)
-    text = font.render(f"Level {level}", True, font_color)
+    text = text_renderer.render(f"Level {level}", 14, font_color)
     textRect = text.get_rect()
     textRect.center = (SCREEN_WIDTH - 180, 30)
     screen.blit(text, textRect)
 
-def main():
-    # Initialize Pygame
-    pygame.init()
-    SCREEN_WIDTH, SCREEN_HEIGHT = 600, 800
-    FPS = 30
-    WHITE = (255, 255, 255)
+SCREEN_WIDTH, SCREEN_HEIGHT = 600, 800
+FPS = 30
+WHITE = (255, 255, 255)
+
+
+class FixedClock:
+    # Game time that only moves when advanced, so runs don't depend on how fast the machine is
+    def __init__(self, tick_ms):
+        self.tick_ms = tick_ms
+        self.ticks = 0
+
+    def advance(self):
+        self.ticks += 1
+
+    def time(self):
+        return self.ticks * self.tick_ms / 1000
+
+
+IDLE_DELAY = 0.3  # seconds without input before the player goes back to the idle animation
+BANNER_DURATION = 2
+TIMER_EPSILON = 1e-6  # repeating timers accumulate float error, don't let it push them to the next tick
+
+
+class Timer:
+    __slots__ = ('due', 'interval', 'callback', 'active', 'queued')
+
+    def __init__(self, due, callback, interval=None):
+        self.due = due
+        self.interval = interval
+        self.callback = callback
+        self.active = True
+        self.queued = None  # due time of this timer's entry in the heap, None when it has none
+
+
+class TimerScheduler:
+    # One-shot and repeating timers on a min-heap. advance() samples the game time once per tick and only
+    # touches the timers that expired, so timer checks cost nothing while nothing is due.
+    def __init__(self, time=0.0):
+        self.time = time
+        self.heap = []
+        self.count = 0
+
+    def _push(self, timer):
+        timer.queued = timer.due
+        heapq.heappush(self.heap, (timer.due, self.count, timer))
+        self.count += 1
+
+    def schedule(self, delay, callback, interval=None):
+        timer = Timer(self.time + delay, callback, interval)
+        self._push(timer)
+        return timer
+
+    def reschedule(self, timer, delay):
+        # Pushing a timer later (the idle timer, every tick the player moves) leaves its heap entry alone,
+        # the entry is moved when it comes up
+        timer.due = self.time + delay
+        timer.active = True
+        if timer.queued is None or timer.due < timer.queued:
+            self._push(timer)
+
+    def cancel(self, timer):
+        timer.active = False
+
+    def remaining(self, timer):
+        return timer.due - self.time if timer.active else 0
+
+    def advance(self, now):
+        self.time = now
+        heap = self.heap
+        while heap and heap[0][0] <= now + TIMER_EPSILON:
+            due, _, timer = heapq.heappop(heap)
+            if due != timer.queued:
+                continue  # replaced by an earlier entry
+            timer.queued = None
+            if not timer.active:
+                continue
+            if timer.due > now + TIMER_EPSILON:
+                self._push(timer)
+                continue
+            if timer.interval:
+                timer.due += timer.interval
+                self._push(timer)
+            else:
+                timer.active = False
+            timer.callback()
+
+
+class ProfileScope:
+    __slots__ = ('profiler', 'name', 'started', 'memory_started')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.started = 0.0
+        self.memory_started = 0
+
+    def __enter__(self):
+        if self.profiler.memory is not None:
+            self.memory_started = self.profiler.memory.begin_scope()
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, self.started, time.perf_counter())
+        if self.profiler.memory is not None:
+            self.profiler.memory.end_scope(self.name, self.memory_started)
+
+
+class NullScope:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SCOPE = NullScope()
+
+
+class MemoryProfiler:
+    # Opt-in allocation tracking for the FrameProfiler scopes. For every scope tracemalloc tells how far traced
+    # memory rose above where it was when the scope started, a lower bound of what the stage allocated, and how
+    # much of it was still alive at the end. GC pauses are timed with gc.callbacks and show up as scopes too.
+    def __init__(self, profiler, warmup_ticks=60):
+        self.profiler = profiler
+        self.warmup_ticks = warmup_ticks
+        self.scopes = {}
+        self.tick_allocated = []
+        self.allocated = 0
+        self.gc_started = None
+        self.gc_collections = [0, 0, 0]
+        self.gc_pauses = []
+        self.level = None
+        self.level_peaks = {}
+
+    def start(self):
+        tracemalloc.start()
+        gc.callbacks.append(self.on_gc)
+
+    def stop(self):
+        if self.on_gc in gc.callbacks:
+            gc.callbacks.remove(self.on_gc)
+        tracemalloc.stop()
+
+    def begin_scope(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.note_peak(peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def end_scope(self, name, started):
+        current, peak = tracemalloc.get_traced_memory()
+        self.note_peak(peak)
+        samples = self.scopes.get(name)
+        if samples is None:
+            samples = self.scopes[name] = []
+        samples.append((peak - started, current - started))
+        self.allocated += peak - started
+
+    def note_peak(self, peak):
+        if peak > self.level_peaks.get(self.level, 0):
+            self.level_peaks[self.level] = peak
+
+    def end_frame(self):
+        self.tick_allocated.append(self.allocated)
+        self.allocated = 0
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_started = time.perf_counter()
+        elif self.gc_started is not None:
+            ended = time.perf_counter()
+            generation = info['generation']
+            self.gc_collections[generation] += 1
+            self.gc_pauses.append((ended - self.gc_started) * 1000)
+            self.profiler.record(f'gc_gen{generation}', self.gc_started, ended)
+            self.gc_started = None
+
+    def steady_state_allocated(self):
+        # Mean bytes allocated per tick once the caches are warm
+        ticks = self.tick_allocated[self.warmup_ticks:] or self.tick_allocated
+        return sum(ticks) / len(ticks) if ticks else 0.0
+
+    def report(self):
+        return {
+            "steady_state_bytes_per_tick": self.steady_state_allocated(),
+            "bytes_per_tick": summarize_tick_times(self.tick_allocated, 'bytes'),
+            "scopes": {name: dict(summarize_tick_times([allocated for allocated, _ in samples], 'bytes'),
+                                  retained_bytes=sum(retained for _, retained in samples))
+                       for name, samples in self.scopes.items()},
+            "gc": {"collections": self.gc_collections, "pauses": summarize_tick_times(self.gc_pauses)},
+            "peak_bytes_per_level": {str(level): peak for level, peak in self.level_peaks.items()},
+        }
 
-    power_bar = PowerBar(max_power=100)
-    power_bar.increase_power(100)
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class FrameProfiler:
+    # Times named scopes of the main loop. When disabled, scope() hands out a shared no-op context manager.
+    # With memory=True every scope also goes through a MemoryProfiler, which slows everything down a lot.
+    def __init__(self, enabled=False, trace=False, history=120, max_trace_events=500000, memory=False):
+        self.recording = enabled or trace or memory
+        self.enabled = self.recording
+        self.overlay = False
+        self.samples = {}
+        self.history = history
+        self.frame_times = deque(maxlen=history)
+        self.trace = trace
+        self.trace_events = []
+        self.max_trace_events = max_trace_events
+        self.frame = 0
+        self.origin = time.perf_counter()
+        self.frame_started = self.origin
+        self.overlay_lines = []
+        self.memory = None
+        if memory:
+            self.memory = MemoryProfiler(self)
+            self.memory.start()
+
+    def scope(self, name):
+        if not self.enabled:
+            return NULL_SCOPE
+        return ProfileScope(self, name)
+
+    def record(self, name, started, ended):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.history)
+        samples.append((ended - started) * 1000)
+        if self.trace and len(self.trace_events) < self.max_trace_events:
+            self.trace_events.append((self.frame, name, started - self.origin, ended - started))
+
+    def end_frame(self):
+        now = time.perf_counter()
+        if self.enabled:
+            self.frame_times.append((now - self.frame_started) * 1000)
+        self.frame_started = now
+        self.frame += 1
+        if self.memory is not None:
+            self.memory.end_frame()
+
+    def set_level(self, stage):
+        if self.memory is not None:
+            self.memory.level = stage
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.stop()
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.enabled = self.overlay or self.recording
+
+    def stats(self):
+        return {name: summarize_tick_times(samples) for name, samples in self.samples.items()}
+
+    def top(self, count=8):
+        stats = self.stats()
+        return sorted(stats.items(), key=lambda item: item[1]['mean_ms'], reverse=True)[:count]
+
+    def draw_overlay(self, screen, x=10, y=50):
+        if not self.overlay:
+            return
+        # Re-render the text a few times a second only, so the overlay doesn't fill the text cache
+        if self.frame % 10 == 0 or not self.overlay_lines:
+            frame_ms = sum(self.frame_times) / len(self.frame_times) if self.frame_times else 0.0
+            fps = 1000 / frame_ms if frame_ms else 0.0
+            self.overlay_lines = [f'FPS {fps:.1f}  frame {frame_ms:.1f}ms']
+            self.overlay_lines += [f"{name} {stat['mean_ms']:.2f}ms p95 {stat['p95_ms']:.2f}ms"
+                                   for name, stat in self.top()]
+        for i, line in enumerate(self.overlay_lines):
+            screen.blit(text_renderer.render(line, 12, (255, 255, 0)), (x, y + i * 14))
+
+    def export_chrome_trace(self, path):
+        events = [{"name": name, "cat": "frame", "ph": "X", "pid": 0, "tid": 0,
+                   "ts": started * 1e6, "dur": duration * 1e6, "args": {"frame": frame}}
+                  for frame, name, started, duration in self.trace_events]
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def export_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'scope', 'start_ms', 'duration_ms'])
+            for frame, name, started, duration in self.trace_events:
+                writer.writerow([frame, name, f'{started * 1000:.3f}', f'{duration * 1000:.3f}'])
+
+    def export(self, path):
+        if path.endswith('.csv'):
+            self.export_csv(path)
+        else:
+            self.export_chrome_trace(path)
+        if self.memory is not None:
+            self.memory.export(os.path.splitext(path)[0] + '.memory.json')
+
+
+class FixedTimestep:
+    # Turns real frame times into a number of fixed simulation steps and decides when to skip rendering
+    def __init__(self, tick_ms, max_catch_up=5, max_frame_skip=3):
+        self.tick_ms = tick_ms
+        self.max_catch_up = max_catch_up
+        self.max_frame_skip = max_frame_skip
+        self.accumulator = 0.0
+        self.skipped_frames = 0
+        self.over_budget = False
+
+    def advance(self, frame_ms):
+        self.accumulator += frame_ms
+        ticks = int(self.accumulator // self.tick_ms)
+        if ticks > self.max_catch_up:
+            # Too far behind to catch up, so the game slows down instead of spiralling
+            ticks = self.max_catch_up
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= ticks * self.tick_ms
+        return ticks
+
+    @property
+    def alpha(self):
+        return min(1.0, self.accumulator / self.tick_ms)
+
+    def should_render(self):
+        if self.over_budget and self.skipped_frames < self.max_frame_skip:
+            self.skipped_frames += 1
+            return False
+        self.skipped_frames = 0
+        return True
+
+    def end_frame(self, work_ms, budget_ms):
+        self.over_budget = work_ms > budget_ms
+
+
+class Game:
+    def __init__(self, screen, num_npcs=3, npc_backend=None, now=None, dirty_rects=False, profiler=None,
+                 tick_ms=1000 / FPS, interpolate=False, wait_for_waves=True, recorder=None, audio=None,
+                 world_size=None, render_scale=1):
+        self.display = screen
+        self.tick_ms = tick_ms
+        self.interpolate = interpolate
+        self.profiler = profiler or FrameProfiler()
+        # A scene drawn at low resolution is upscaled over the whole screen every frame, there is nothing to skip
+        dirty_rects = dirty_rects and render_scale == 1
+        self.screen = DirtyRectScreen(screen) if dirty_rects else screen
+        self.dirty_rects = dirty_rects
+        self.previous_rects = None
+        # Game time advances one tick_ms per update, so timers behave the same however fast frames are rendered
+        self.clock = FixedClock(tick_ms) if now is None else None
+        self.now = now or self.clock.time
+        self.recorder = recorder
+        self.audio = audio
+        self.duration = 60
+
+        if not sprite_sheet_cache.bundled:
+            sprite_sheet_cache.load_bundle()
+        # With render_scale > 1 terrain and sprites are kept render_scale times smaller, drawn into self.scene and
+        # upscaled to the screen once per frame. Text, projectiles and power balls are drawn over it at full size.
+        self.render_scale = render_scale
+        sprite_sheet_cache.render_scale = render_scale
+        self.scene = None
+        if render_scale > 1:
+            self.scene = pygame.Surface((SCREEN_WIDTH // render_scale, SCREEN_HEIGHT // render_scale)).convert()
+
+        self.power_bar = PowerBar(max_power=100)
+        self.power_bar.increase_power(100)
+        self.timers = TimerScheduler(self.now())
+
+        terrain = pygame.image.load("assets/terrain.png").convert_alpha()
+        self.terrain = pygame.transform.scale(terrain, (int(SCREEN_WIDTH * 0.5 / render_scale),
+                                                        int(SCREEN_HEIGHT * 0.5 / render_scale)))
+        # Everything is simulated in world coordinates, the camera picks the part that is drawn
+        world_width, world_height = world_size or (SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.tile_map = TileMap(self.terrain, world_width // render_scale, world_height // render_scale)
+        self.camera = Camera(SCREEN_WIDTH, SCREEN_HEIGHT, world_width, world_height)
+        self.drawn_offset = None
+
+        self.npcs = create_npcs(world_width, world_height, num_npcs=num_npcs, backend=npc_backend)
+        self.player = create_player()
+
+        self.level = Level(npcs=num_npcs, stage=1, npc_backend=npc_backend)
+        self.waves = WaveLoader(world_width, world_height, npc_backend, wait=wait_for_waves)
+        self.waves.prepare(num_npcs + 4)
+
+        self.level_expired = False
+        self.show_banner = True
+        self.level_timer = self.timers.schedule(self.duration, self.expire_level)
+        self.banner_timer = self.timers.schedule(BANNER_DURATION, self.hide_banner)
+        self.idle_timer = self.timers.schedule(IDLE_DELAY, self.go_idle)
+        regen_interval = tick_ms / 1000
+        self.timers.schedule(regen_interval, lambda: update_power_bar(self.power_bar, tick_ms), regen_interval)
+        self.projectiles = ObjectPool(Projectile, capacity=256)
+        self.sprite_batch = SpriteBatch(render_scale)
+        self.animation_clock = 0
+        self.player.set_animation('idle')
+        self.power_balls = ObjectPool(PowerBall, capacity=16)
+        self.follow_player(self.player.x_position, self.player.y_position)
+        self.profiler.set_level(self.level.stage)
+
+    def expire_level(self):
+        self.level_expired = True
+
+    def hide_banner(self):
+        self.show_banner = False
+
+    def go_idle(self):
+        if self.player.get_current_animation() != 'defeated':
+            self.player.set_animation('idle')
+
+    def follow_player(self, x, y):
+        player = self.player
+        self.camera.follow(x + player.get_frame_width() / 2, y + player.get_frame_height() / 2)
+
+    def start_level(self):
+        self.profiler.set_level(self.level.stage)
+        self.level_expired = False
+        self.show_banner = True
+        self.timers.reschedule(self.level_timer, self.duration)
+        self.timers.reschedule(self.banner_timer, BANNER_DURATION)
+
+    def tick(self, elapsed_time, input_frame=None):
+        self.update(input_frame)
+        self.render(elapsed_time)
+
+    def update(self, input_frame=None):
+        # Advances the simulation by one fixed step of tick_ms, without drawing anything
+        player, profiler = self.player, self.profiler
+        projectiles, power_balls, power_bar = self.projectiles, self.power_balls, self.power_bar
+        self.timers.advance(self.now())
+
+        if input_frame is None:
+            input_frame = read_input(pygame)
+        if self.recorder is not None:
+            self.recorder.record(input_frame)
+        for event in input_frame.events:
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                profiler.toggle_overlay()
+
+        if self.interpolate:
+            player.store_previous_position()
+            store_previous_positions(self.npcs)
+        with profiler.scope('handle_events'):
+            # The mouse is on the screen, aiming is compared against world positions. render() leaves the camera on
+            # the interpolated position, so it is put back on the simulated one first or replays would drift.
+            self.follow_player(player.x_position, player.y_position)
+            world_input = InputFrame(input_frame.events, input_frame.keys, self.camera.to_world(input_frame.mouse_pos))
+            handle_events(player, self.timers, self.idle_timer, pygame, projectiles, power_balls, power_bar,
+                          world_input, self.audio)
+            self.follow_player(player.x_position, player.y_position)
+        with profiler.scope('spawn_wave'):
+            if self.waves.spawning:
+                self.waves.spawn(self.npcs)
+        with profiler.scope('update_collision_boxes'):
+            update_npc_collision_box(self.npcs)
+            player.update_collision_box()
+            npc_grid = build_npc_grid(self.npcs)
+        with profiler.scope('move_npcs'):
+            move_npcs(self.npcs, player)
+        with profiler.scope('npc_collisions'):
+            apply_damage_to_player(player, self.npcs, npc_grid)
+            remove_dead_npcs(self.npcs, npc_grid)
+        with profiler.scope('projectiles'):
+            move_projectile(projectiles)
+            check_colision_with_projectile(projectiles, self.npcs, npc_grid)
+        with profiler.scope('next_level'):
+            advanced, self.level, self.npcs = next_level(self.level, self.level_expired, self.npcs, None, power_bar,
+                                                         SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE,
+                                                         waves=self.waves)
+            if advanced:
+                self.start_level()
+                npc_grid = build_npc_grid(self.npcs)
+            check_game_over(player, None, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
+        with profiler.scope('power_balls'):
+            check_collision_with_power_balls(power_balls, self.npcs, npc_grid)
+        with profiler.scope('cull_projectiles'):
+            remove_projectiles_out_of_bounds(projectiles, self.camera.rect.clip(self.camera.bounds))
+        if self.clock is not None:
+            self.clock.advance()
+
+    def render(self, elapsed_time, alpha=1.0):
+        # alpha is how far the renderer is between the last two simulation steps, 1.0 draws the latest state
+        screen, player, profiler, camera = self.screen, self.player, self.profiler, self.camera
+        player_position = player.interpolated_position(alpha) if alpha < 1 else (player.x_position, player.y_position)
+        self.follow_player(*player_position)
+        offset_x, offset_y = camera.offset
+
+        with profiler.scope('draw_background'):
+            self.draw_background()
+        self.animation_clock += elapsed_time
+        with profiler.scope('draw_sprites'):
+            player.sprite.update(elapsed_time)
+            self.sprite_batch.add(player.sprite.current_surface(), player_position)
+            draw_npcs(self.npcs, screen, self.animation_clock, alpha, self.sprite_batch, camera.rect)
+            if self.scene is None:
+                self.sprite_batch.flush(screen, camera.offset)
+            else:
+                self.sprite_batch.flush(self.scene, camera.offset, layer=0)
+        if self.scene is not None:
+            with profiler.scope('upscale_scene'):
+                pygame.transform.scale(self.scene, screen.get_size(), screen)
+            self.sprite_batch.flush(screen, camera.offset)
+        with profiler.scope('draw_hud'):
+            draw_hp(player, screen, font_color=WHITE,
+                    position=(player_position[0] - offset_x, player_position[1] - offset_y))
+            display_level(screen, self.level.stage, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
+            self.power_bar.draw(screen, 30, 20, 100, 10)
+            render_time_remaining(screen, self.timers.remaining(self.level_timer), SCREEN_WIDTH, font_color=WHITE)
+            if self.show_banner:
+                draw_level_banner(screen, self.level, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
+            if player.hp <= 0:
+                draw_game_over(screen, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
+        with profiler.scope('draw_projectiles'):
+            draw_projectiles(self.projectiles, screen, camera.offset, alpha)
+            # Power balls don't move, their radius still grows in 30 Hz steps since every radius is a cached frame
+            draw_power_balls(self.power_balls, screen, camera.offset)
+        profiler.draw_overlay(screen)
+
+    def draw_background(self):
+        view = self.camera.rect
+        if self.scene is not None:
+            n = self.render_scale
+            self.tile_map.draw(self.scene, pygame.Rect(view.x // n, view.y // n, view.width // n, view.height // n))
+            return
+        if self.drawn_offset != view.topleft:
+            # The camera scrolled, every pixel on screen changes
+            self.drawn_offset = view.topleft
+            self.previous_rects = None
+        if not self.dirty_rects or self.previous_rects is None:
+            self.tile_map.draw(self.display, view)
+            return
+        # Only put the terrain back where something was drawn last frame
+        for rect in self.previous_rects:
+            self.tile_map.draw(self.display, view, rect)
+        self.screen.rects = []
+
+    def present(self):
+        with self.profiler.scope('display_update'):
+            if not self.dirty_rects:
+                pygame.display.update()
+            elif self.previous_rects is None:
+                pygame.display.update()
+                self.previous_rects, self.screen.rects = self.screen.rects, []
+            else:
+                pygame.display.update(self.previous_rects + self.screen.rects)
+                self.previous_rects, self.screen.rects = self.screen.rects, []
+        self.profiler.end_frame()
+
+
+WORLD_HEADER = ('seq', 'tick', 'player_x', 'player_y', 'player_hp', 'player_animation', 'player_flip', 'stage',
+                'time', 'level_end', 'banner', 'power', 'npc_count', 'projectile_count', 'power_ball_count')
+WORLD_PROJECTILE_FIELDS = 4  # x, y, width, height
+WORLD_POWER_BALL_FIELDS = 6  # x, y, radius, initial_radius, max_radius, expansion_speed
+
+
+class SharedWorldState:
+    # Two snapshot slots of float64 in shared memory. The simulation writes into the slot the renderer is not
+    # pointed at and then publishes it. Each slot carries a sequence number that is odd while it is being written,
+    # so a reader that raced with the writer notices and keeps the snapshot it already has. The numbers count
+    # publishes across both slots, so every snapshot has its own.
+    def __init__(self, npc_capacity, name=None, projectile_capacity=256, power_ball_capacity=16):
+        self.npc_capacity = npc_capacity
+        self.projectile_capacity = projectile_capacity
+        self.power_ball_capacity = power_ball_capacity
+        self.header = {field: i for i, field in enumerate(WORLD_HEADER)}
+        header_size = len(WORLD_HEADER)
+        self.npc_offset = header_size
+        self.projectile_offset = self.npc_offset + 4 * npc_capacity
+        self.power_ball_offset = self.projectile_offset + WORLD_PROJECTILE_FIELDS * projectile_capacity
+        self.slot_size = self.power_ball_offset + WORLD_POWER_BALL_FIELDS * power_ball_capacity
+        size = 8 * (1 + 2 * self.slot_size)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.buffer = np.ndarray((1 + 2 * self.slot_size,), dtype=np.float64, buffer=self.shm.buf)
+        if self.owner:
+            self.buffer[:] = 0
+        self.slots = [self.buffer[1 + i * self.slot_size:1 + (i + 1) * self.slot_size] for i in range(2)]
+        # Published snapshots start at 2, the zeroed slots are not a snapshot and the view keeps its own state
+        self.seq = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, game):
+        index = 1 - int(self.buffer[0])
+        slot = self.slots[index]
+        field = self.header
+        seq = max(self.slots[0][0], self.slots[1][0]) + 2
+        slot[0] = seq - 1
+        player = game.player
+        slot[field['tick']] = game.clock.ticks
+        slot[field['player_x']] = player.x_position
+        slot[field['player_y']] = player.y_position
+        slot[field['player_hp']] = player.hp
+        slot[field['player_animation']] = list(player.sprite.animations).index(player.sprite.current_animation)
+        slot[field['player_flip']] = player.sprite.flip_vertically
+        slot[field['stage']] = game.level.stage
+        slot[field['time']] = game.timers.time
+        slot[field['level_end']] = game.level_timer.due
+        slot[field['banner']] = game.show_banner
+        slot[field['power']] = game.power_bar.current_power
+
+        # Waves bigger than the buffer are simulated in full but only the first npc_capacity are shown
+        npcs = game.npcs
+        n = min(len(npcs), self.npc_capacity)
+        columns = slot[self.npc_offset:self.projectile_offset].reshape(4, self.npc_capacity)
+        if isinstance(npcs, NpcBatch):
+            columns[0, :n] = npcs.x[:n]
+            columns[1, :n] = npcs.y[:n]
+            columns[2, :n] = npcs.hp[:n]
+            columns[3, :n] = npcs.phase[:n]
+        else:
+            for i, npc in enumerate(npcs[:n]):
+                columns[:, i] = (npc.x_position, npc.y_position, npc.hp, npc.sprite.phase)
+        slot[field['npc_count']] = n
+
+        rows = slot[self.projectile_offset:self.power_ball_offset].reshape(-1, WORLD_PROJECTILE_FIELDS)
+        count = 0
+        for projectile in game.projectiles:
+            if count == self.projectile_capacity:
+                break
+            rows[count] = projectile.rect
+            count += 1
+        slot[field['projectile_count']] = count
+
+        rows = slot[self.power_ball_offset:].reshape(-1, WORLD_POWER_BALL_FIELDS)
+        count = 0
+        for ball in game.power_balls:
+            if count == self.power_ball_capacity:
+                break
+            rows[count] = (ball.x, ball.y, ball.radius, ball.initial_radius, ball.max_radius, ball.expansion_speed)
+            count += 1
+        slot[field['power_ball_count']] = count
+
+        slot[0] = seq
+        self.buffer[0] = index
+
+    def read_into(self, game):
+        # Copies the latest complete snapshot into a render-only Game, returns False if there is nothing new
+        slot = self.slots[int(self.buffer[0])]
+        seq = slot[0]
+        if seq == self.seq or seq % 2:
+            return False
+        field = self.header
+        header = slot[:self.npc_offset].copy()
+        n = int(header[field['npc_count']])
+        npcs = slot[self.npc_offset:self.projectile_offset].reshape(4, self.npc_capacity)[:, :n].copy()
+        projectiles = slot[self.projectile_offset:self.power_ball_offset].reshape(-1, WORLD_PROJECTILE_FIELDS)
+        projectiles = projectiles[:int(header[field['projectile_count']])].copy()
+        power_balls = slot[self.power_ball_offset:].reshape(-1, WORLD_POWER_BALL_FIELDS)
+        power_balls = power_balls[:int(header[field['power_ball_count']])].copy()
+        if slot[0] != seq:
+            return False  # The writer came around to this slot while we were copying it
+        self.seq = seq
+
+        player = game.player
+        player.x_position = header[field['player_x']]
+        player.y_position = header[field['player_y']]
+        player.hp = int(header[field['player_hp']])
+        player.set_animation(list(player.sprite.animations)[int(header[field['player_animation']])])
+        player.sprite.flip_vertically = bool(header[field['player_flip']])
+        game.level.stage = int(header[field['stage']])
+        game.timers.time = header[field['time']]
+        game.level_timer.due = header[field['level_end']]
+        game.show_banner = bool(header[field['banner']])
+        game.power_bar.current_power = header[field['power']]
+        game.clock.ticks = int(header[field['tick']])
+        game.npcs.load(npcs[0], npcs[1], npcs[2], npcs[3])
+        game.projectiles.clear()
+        for x, y, width, height in projectiles:
+            game.projectiles.spawn(int(x), int(y), int(width), int(height), 0, 0)
+        game.power_balls.clear()
+        for x, y, radius, initial_radius, max_radius, expansion_speed in power_balls:
+            ball = game.power_balls.spawn(x, y, int(initial_radius), int(max_radius), int(expansion_speed), 0, 0)
+            ball.radius = int(radius)
+        return True
+
+    def close(self):
+        self.slots = self.buffer = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def summarize_tick_times(tick_times, unit='ms'):
+    ordered = sorted(tick_times)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+    return {
+        "ticks": len(ordered),
+        f"mean_{unit}": sum(ordered) / len(ordered) if ordered else 0.0,
+        f"p50_{unit}": percentile(50),
+        f"p95_{unit}": percentile(95),
+        f"p99_{unit}": percentile(99),
+        f"max_{unit}": ordered[-1] if ordered else 0.0,
+    }
+
+
+def run_headless(ticks, seed=0, num_npcs=3, npc_backend=None, script=None, dirty_rects=False, profiler=None,
+                 tick_ms=1000 / FPS, world_size=None, render_scale=1):
+    # Runs the game without a window or audio on a fixed tick clock and returns the duration of each tick in ms.
+    # script(tick, game) returns the InputFrame for that tick, or None for no input.
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    random.seed(seed)
+
+    game = Game(screen, num_npcs=num_npcs, npc_backend=npc_backend, dirty_rects=dirty_rects, profiler=profiler,
+                tick_ms=tick_ms, world_size=world_size, render_scale=render_scale)
+    tick_times = []
+    for tick in range(ticks):
+        input_frame = script(tick, game) if script else None
+        if input_frame is None:
+            input_frame = InputFrame([], PressedKeys(), (0, 0))
+        pygame.event.pump()
+        started = time.perf_counter()
+        game.tick(tick_ms, input_frame)
+        game.present()
+        tick_times.append((time.perf_counter() - started) * 1000)
+    game.waves.shutdown()
+    return tick_times
+
+
+def run_replay(path, dirty_rects=False, profiler=None):
+    # Plays a log written with --record back through the same input path, without a window
+    replay = InputReplay(path)
+    return run_headless(len(replay), replay.seed, replay.num_npcs, replay.npc_backend, replay.script,
+                        dirty_rects=dirty_rects, profiler=profiler, tick_ms=replay.tick_ms,
+                        world_size=replay.world_size)
+
+
+def main(npc_backend=None, dirty_rects=False, profiler=None, render_fps=FPS, record_path=None, world_size=None,
+         render_scale=1):
+    # Initialize Pygame, the mixer is left to AudioSystem so it opens on the loader thread
+    pygame.display.init()
+    pygame.font.init()
 
     # Create screen and clock
     screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     pygame.display.set_caption('Sprite Sheet Animation')
     clock = pygame.time.Clock()
-
-    terrain = pygame.image.load("assets/terrain.png").convert_alpha()
-    terrain = pygame.transform.scale(terrain, (int(SCREEN_WIDTH * 0.5), int(SCREEN_HEIGHT * 0.5)))
-
-    npcs = create_npcs(SCREEN_WIDTH, SCREEN_HEIGHT, num_npcs=3)
-    player = create_player()
-
-    level = Level(npcs=3, stage=1)
-
-    start_time = time.time()
-    idle_time = time.time()
-    projectiles = []
-    player.set_animation('idle')
-    power_balls = []
-
-    play_game_music(pygame)
-
+    audio = AudioSystem().start()
+
+    # The simulation always steps at FPS, rendering runs at render_fps and is skipped when frames run late
+    timestep = FixedTimestep(1000 / FPS)
+    recorder = None
+    wait_for_waves = False
+    if record_path:
+        # Spawning must not depend on frame timing, or the replay would drift from the recording
+        seed = random.randrange(2 ** 63)
+        random.seed(seed)
+        recorder = InputRecorder(record_path, seed, timestep.tick_ms, 3, npc_backend, world_size)
+        wait_for_waves = True
+    game = Game(screen, npc_backend=npc_backend, dirty_rects=dirty_rects, profiler=profiler,
+                tick_ms=timestep.tick_ms, interpolate=render_fps != FPS, wait_for_waves=wait_for_waves,
+                recorder=recorder, audio=audio, world_size=world_size, render_scale=render_scale)
+
+    try:
+        game_loop(game, clock, timestep, render_fps)
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+def game_loop(game, clock, timestep, render_fps):
     # Main game loop
+    render_elapsed = 0
     while True:
-        elapsed_time = clock.get_time()
-
-        idle_time = handle_events(player, idle_time, pygame, projectiles, power_balls, power_bar)
-        duration = 60
-        draw_tiles(screen, terrain, SCREEN_WIDTH, SCREEN_HEIGHT)
-        player.draw_sprite(screen, elapsed_time)
-        draw_npcs(npcs, screen, elapsed_time)
-        draw_hp(player, screen, font_color=WHITE)
-        update_power_bar(power_bar, elapsed_time)
-        display_level(screen, level.stage, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
-        power_bar.draw(screen, 30, 20, 100, 10)
-        render_time_remaining(screen, start_time, SCREEN_WIDTH, font_color=WHITE)
-        update_npc_collision_box(npcs)
-        player.update_collision_box()
-        move_npcs(npcs, player)
-        apply_damage_to_player(player, npcs)
-        remove_dead_npcs(npcs)
-        move_projectile(projectiles, screen)
-        check_colision_with_projectile(projectiles, npcs)
-        start_time, level, npcs = next_level(level, start_time, duration, npcs, screen, power_bar,
-                                             SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
-        check_game_over(player, screen, SCREEN_WIDTH, SCREEN_HEIGHT, font_color=WHITE)
-        draw_power_balls(power_balls, screen)
-        check_collision_with_power_balls(power_balls, npcs)
-        remove_projectile_out_of_screen(projectiles, SCREEN_WIDTH, SCREEN_HEIGHT)
-
-        pygame.display.update()
-        clock.tick(FPS)
+        frame_ms = clock.get_time()
+        started = time.perf_counter()
+
+        ticks = timestep.advance(frame_ms)
+        if ticks:
+            input_frame = read_input(pygame)
+            game.update(input_frame)
+            held_input = InputFrame([], input_frame.keys, input_frame.mouse_pos)
+            for _ in range(ticks - 1):
+                game.update(held_input)
+        else:
+            pygame.event.pump()
+
+        render_elapsed += frame_ms
+        if timestep.should_render():
+            game.render(render_elapsed, timestep.alpha if game.interpolate else 1.0)
+            game.present()
+            render_elapsed = 0
+
+        timestep.end_frame((time.perf_counter() - started) * 1000, 1000 / render_fps)
+        clock.tick(render_fps)
+
+
+def run_simulation_process(world_name, npc_capacity, input_queue, stop_event, seed, num_npcs, npc_backend,
+                           world_size=None):
+    # Steps the game at FPS in its own process and publishes every result to the shared world state
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+    screen = pygame.display.set_mode((1, 1))
+    random.seed(seed)
+    world = SharedWorldState(npc_capacity, world_name)
+    game = Game(screen, num_npcs=num_npcs, npc_backend=npc_backend, world_size=world_size)
+    timestep = FixedTimestep(game.tick_ms)
+    input_frame = InputFrame([], PressedKeys(), (0, 0))
+    world.write(game)
+
+    last = time.perf_counter()
+    try:
+        while not stop_event.is_set():
+            now = time.perf_counter()
+            ticks = timestep.advance((now - last) * 1000)
+            last = now
+            for _ in range(ticks):
+                events = []
+                while True:
+                    try:
+                        data = input_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    input_frame, _ = decode_input_frame(data, 0, input_frame.mouse_pos)
+                    events.extend(input_frame.events)
+                game.update(InputFrame(events, input_frame.keys, input_frame.mouse_pos))
+            if ticks:
+                world.write(game)
+            else:
+                time.sleep(0.001)
+    finally:
+        game.waves.shutdown()
+        world.close()
+
+
+def main_multiprocess(npc_backend=None, dirty_rects=False, profiler=None, num_npcs=3, npc_capacity=20000,
+                      world_size=None, render_scale=1):
+    # The simulation runs in a second process and this one only reads input and draws the latest snapshot
+    if np is None:
+        print("NumPy is not installed, running the simulation in this process")
+        return main(npc_backend=npc_backend, dirty_rects=dirty_rects, profiler=profiler, world_size=world_size,
+                    render_scale=render_scale)
+
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption('Sprite Sheet Animation')
+    clock = pygame.time.Clock()
+    audio = AudioSystem().start()
+
+    world = SharedWorldState(npc_capacity)
+    input_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    seed = random.randrange(2 ** 63)
+    simulation = multiprocessing.Process(target=run_simulation_process, daemon=True,
+                                         args=(world.name, npc_capacity, input_queue, stop_event, seed, num_npcs,
+                                               npc_backend, world_size))
+    simulation.start()
+
+    # The view only holds what the renderer needs, every field is overwritten from the snapshot
+    view = Game(screen, num_npcs=0, npc_backend='numpy', dirty_rects=dirty_rects, profiler=profiler,
+                world_size=world_size, render_scale=render_scale)
+    view.waves.shutdown()
+
+    try:
+        while simulation.is_alive():
+            frame_ms = clock.get_time()
+            input_frame = read_input(pygame)
+            for event in input_frame.events:
+                if event.type == pygame.QUIT:
+                    return
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    view.profiler.toggle_overlay()
+                # Effects are played here from the input, the simulation process has no audio
+                if event.type == pygame.MOUSEBUTTONDOWN and view.player.get_current_animation() != 'defeated':
+                    if event.button == 1:
+                        audio.play('shot')
+                    elif event.button == 3 and view.power_bar.get_power_level() >= 100:
+                        audio.play('power_ball')
+            input_queue.put(encode_input_frame(input_frame))
+
+            world.read_into(view)
+            view.render(frame_ms)
+            view.present()
+            clock.tick(FPS)
+        print(f"The simulation process stopped (exit code {simulation.exitcode})")
+    finally:
+        stop_event.set()
+        simulation.join(timeout=1)
+        world.close()
+        pygame.quit()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Violet')
+    parser.add_argument('--numpy-npcs', action='store_true', help='simulate NPCs with the NumPy backend')
+    parser.add_argument('--dirty-rects', action='store_true', help='only redraw and update the changed parts of the screen')
+    parser.add_argument('--profile', action='store_true', help='time each stage of the main loop (F3 shows the overlay)')
+    parser.add_argument('--track-allocations', action='store_true',
+                        help='count allocations per stage and GC pauses with tracemalloc (slow)')
+    parser.add_argument('--trace-out', help='write the profile as a Chrome trace (.json) or CSV (.csv) on exit')
+    parser.add_argument('--render-fps', type=int, default=FPS, help='render rate, the simulation always runs at %d Hz' % FPS)
+    parser.add_argument('--build-assets', action='store_true', help='pack the sprite sheets into %s' % ASSET_BUNDLE_PIXELS)
+    parser.add_argument('--world', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='size of the arena, the camera follows the player (default: the window size)')
+    parser.add_argument('--render-scale', type=int, default=1,
+                        help='draw terrain and sprites this many times smaller and upscale them once per frame '
+                             '(without losing pixels: 1 for the player sprites, up to 2 for the NPCs)')
+    parser.add_argument('--multiprocess', action='store_true', help='run the simulation in a separate process')
+    parser.add_argument('--record', help='write the seed and every tick of input to this replay file')
+    parser.add_argument('--replay', help='play a recorded session back without a window and print tick timings')
+    parser.add_argument('--headless', action='store_true', help='run without window or audio and print tick timings')
+    parser.add_argument('--ticks', type=int, default=600, help='number of ticks to run in headless mode')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for headless mode')
+    parser.add_argument('--npcs', type=int, default=3, help='size of the first wave in headless mode')
+    args = parser.parse_args()
+    npc_backend = 'numpy' if args.numpy_npcs else None
+    profiler = FrameProfiler(enabled=args.profile, trace=bool(args.trace_out), memory=args.track_allocations)
+    try:
+        if args.build_assets:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            pygame.init()
+            pygame.display.set_mode((1, 1))
+            print('Atlas size: %dx%d' % build_asset_bundle())
+        elif args.headless or args.replay:
+            if args.replay:
+                tick_times = run_replay(args.replay, dirty_rects=args.dirty_rects, profiler=profiler)
+            else:
+                tick_times = run_headless(args.ticks, args.seed, args.npcs, npc_backend, dirty_rects=args.dirty_rects,
+                                          profiler=profiler, world_size=args.world, render_scale=args.render_scale)
+            report = summarize_tick_times(tick_times)
+            if profiler.recording:
+                report["scopes"] = profiler.stats()
+            if profiler.memory is not None:
+                report["memory"] = profiler.memory.report()
+            print(json.dumps(report, indent=2))
+        elif args.multiprocess:
+            main_multiprocess(npc_backend=npc_backend, dirty_rects=args.dirty_rects, profiler=profiler,
+                              world_size=args.world, render_scale=args.render_scale)
+        else:
+            main(npc_backend=npc_backend, dirty_rects=args.dirty_rects, profiler=profiler, render_fps=args.render_fps,
+                 record_path=args.record, world_size=args.world, render_scale=args.render_scale)
+    finally:
+        if args.trace_out:
+            profiler.export(args.trace_out)
+        profiler.close()